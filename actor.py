@@ -0,0 +1,131 @@
+import asyncio
+
+
+class Turn:
+    """One submitted debtor message; iterate it for the reply deltas.
+
+    Any number of readers may iterate it, e.g. a client and its retry of the
+    same turn_id; each gets every delta from the start.
+    """
+
+    __slots__ = ("text", "turn_id", "deltas", "readers", "done", "task", "started", "cancelled")
+
+    def __init__(self, text, turn_id=None):
+        self.text = text
+        self.turn_id = turn_id
+        self.deltas = []
+        self.readers = []
+        self.done = False
+        self.task = None
+        self.started = False
+        self.cancelled = False
+
+    def put(self, delta):
+        self.deltas.append(delta)
+        for reader in self.readers:
+            reader.put_nowait(delta)
+
+    def end(self):
+        if not self.done:
+            self.done = True
+            for reader in self.readers:
+                reader.put_nowait(None)
+
+    def cancel(self):
+        # False if the turn had already finished
+        if self.cancelled or (self.task is not None and self.task.done()):
+            return False
+        self.cancelled = True
+        if self.task is None:
+            # Still in the mailbox; it will be skipped
+            self.end()
+        else:
+            self.task.cancel()
+        return True
+
+    async def __aiter__(self):
+        reader = asyncio.Queue()
+        for delta in self.deltas:
+            reader.put_nowait(delta)
+        if self.done:
+            reader.put_nowait(None)
+        self.readers.append(reader)
+        try:
+            while True:
+                delta = await reader.get()
+                if delta is None:
+                    return
+                yield delta
+        finally:
+            self.readers.remove(reader)
+
+    async def reply(self):
+        return "".join([delta async for delta in self])
+
+
+class ConversationActor:
+    """Runs one conversation's turns strictly one at a time, in order, from a mailbox.
+
+    Nothing else should call into the bot while an actor owns it. With
+    supersede on, a new message cancels the turn in flight and any still
+    waiting, including its LLM call; the bot records the cancelled turn in
+    its transcript.
+    """
+
+    def __init__(self, bot, supersede=True):
+        self.bot = bot
+        self.supersede = supersede
+        self.mailbox = asyncio.Queue()
+        self.cancelled_turns = 0
+        self._pending = []
+        self._worker = None
+
+    def submit(self, text, turn_id=None):
+        # A repeat of a turn still queued or running joins it rather than superseding it
+        for turn in self._pending:
+            if turn_id is not None and turn.turn_id == turn_id and not turn.cancelled:
+                self.bot.dedupe_hits += 1
+                return turn
+        if self.supersede:
+            for turn in self._pending:
+                if turn.cancel():
+                    self.cancelled_turns += 1
+        turn = Turn(text, turn_id)
+        self._pending.append(turn)
+        self.mailbox.put_nowait(turn)
+        if self._worker is None:
+            self._worker = asyncio.ensure_future(self._run())
+        return turn
+
+    async def _run(self):
+        while True:
+            turn = await self.mailbox.get()
+            if not turn.cancelled:
+                turn.task = asyncio.ensure_future(self._play(turn))
+                # wait() rather than await, so a cancelled turn does not stop the worker
+                await asyncio.wait({turn.task})
+            if not turn.started:
+                self._skip(turn)
+            turn.end()
+            self._pending.remove(turn)
+
+    async def _play(self, turn):
+        turn.started = True
+        stream = self.bot.astream_response(turn.text, turn.turn_id)
+        try:
+            async for delta in stream:
+                turn.put(delta)
+        finally:
+            await stream.aclose()
+
+    def _skip(self, turn):
+        # Superseded before it started: no agent saw it, but the transcript keeps it
+        transcript = self.bot.transcript
+        transcript.append(None, "user", turn.text)
+        transcript.cancel(len(transcript) - 1)
+
+    def close(self):
+        for turn in self._pending:
+            turn.cancel()
+        if self._worker is not None:
+            self._worker.cancel()
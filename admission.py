@@ -0,0 +1,113 @@
+import asyncio
+import os
+import threading
+import time
+from collections import deque
+
+
+class AdmissionController:
+    """Decides whether a conversation that has not yet passed verification may go on.
+
+    The transport reports every upstream LLM call to it. While too many calls
+    are in flight, recent first-token latency is too high or too many recent
+    calls failed, such conversations (new ones included) are refused with a
+    retry_after, after waiting up to defer_seconds for the load to clear.
+    Conversations past verification are always let through, so the calls that
+    matter most keep the capacity that is left.
+    """
+
+    def __init__(self, max_in_flight=64, max_latency=8.0, max_error_rate=0.5, percentile=90, min_samples=10,
+                 window=100, defer_seconds=0.0, retry_after=30):
+        self.max_in_flight = max_in_flight
+        self.max_latency = max_latency
+        self.max_error_rate = max_error_rate
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.defer_seconds = defer_seconds
+        self.retry_after = retry_after
+        self.in_flight = 0
+        self._latencies = deque(maxlen=window)
+        self._outcomes = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self._stats = {"admitted": 0, "deferred": 0, "shed": 0, "protected": 0}
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            max_in_flight=int(os.getenv("ADMISSION_MAX_IN_FLIGHT", 64)),
+            max_latency=float(os.getenv("ADMISSION_MAX_LATENCY", 8)),
+            max_error_rate=float(os.getenv("ADMISSION_MAX_ERROR_RATE", 0.5)),
+            defer_seconds=float(os.getenv("ADMISSION_DEFER", 0)),
+            retry_after=int(os.getenv("ADMISSION_RETRY_AFTER", 30)),
+        )
+
+    def call_started(self):
+        with self._lock:
+            self.in_flight += 1
+
+    def call_finished(self, latency=None, failed=False):
+        # latency is the time to the first chunk, None when there was none
+        with self._lock:
+            self.in_flight -= 1
+            self._outcomes.append(failed)
+            if latency is not None:
+                self._latencies.append(latency)
+
+    def overload(self):
+        """Why new work should be turned away right now, or None."""
+        with self._lock:
+            in_flight = self.in_flight
+            latencies = sorted(self._latencies)
+            outcomes = list(self._outcomes)
+        if in_flight >= self.max_in_flight:
+            return f"{in_flight} LLM calls in flight"
+        if len(latencies) >= self.min_samples:
+            latency = latencies[int(self.percentile / 100 * (len(latencies) - 1))]
+            if latency > self.max_latency:
+                return f"LLM latency p{self.percentile:g} is {latency:.1f}s"
+        if len(outcomes) >= self.min_samples:
+            error_rate = sum(outcomes) / len(outcomes)
+            if error_rate > self.max_error_rate:
+                return f"{error_rate:.0%} of recent LLM calls failed"
+        return None
+
+    def admit(self, protected=False):
+        """{"admitted": bool, "reason": ..., "retry_after": seconds} for one conversation turn or start."""
+        reason = self.overload()
+        if reason is None or protected:
+            self._count("protected" if reason else "admitted")
+            return {"admitted": True, "reason": None, "retry_after": None}
+        self._count("shed")
+        return {"admitted": False, "reason": reason, "retry_after": self.retry_after}
+
+    async def aadmit(self, protected=False):
+        # Like admit(), but first waits up to defer_seconds for the load to clear
+        if not protected and self.defer_seconds and self.overload():
+            self._count("deferred")
+            deadline = time.monotonic() + self.defer_seconds
+            while self.overload() and time.monotonic() < deadline:
+                await asyncio.sleep(min(0.25, self.defer_seconds))
+        return self.admit(protected)
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def stats(self):
+        """Decisions so far (shed is the number turned away) and the load they were based on."""
+        with self._lock:
+            stats = dict(self._stats, in_flight=self.in_flight)
+        stats["overload"] = self.overload()
+        return stats
+
+
+_controller = None
+_controller_lock = threading.Lock()
+
+
+def get_admission_controller():
+    global _controller
+    with _controller_lock:
+        if _controller is None:
+            _controller = AdmissionController.from_env()
+        return _controller
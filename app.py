@@ -1,5 +1,9 @@
+import uuid
+
 import streamlit as st
-from horse import MultiAgentDebtCollectionBot
+from admission import get_admission_controller
+from horse import MultiAgentDebtCollectionBot, configured_models
+from llm_client import is_ready, warm_up
 
 # Page config
 st.set_page_config(
@@ -8,39 +12,51 @@ st.set_page_config(
     layout="centered"
 )
 
-# Initialize session state
+# Warm the shared connection pool once per process, before the first session;
+# retried on a later rerun, at most every LLM_WARMUP_RETRY seconds, if the API
+# could not be reached
+if not is_ready():
+    warm_up(configured_models())
+
+# Initialize session state; new sessions are turned away while the LLM API is overloaded
 if 'bot' not in st.session_state:
+    admission = get_admission_controller().admit()
+    if not admission["admitted"]:
+        st.warning(f"We are busy right now ({admission['reason']}). Please retry in {admission['retry_after']} seconds.")
+        st.stop()
     st.session_state.bot = MultiAgentDebtCollectionBot()
-if 'messages' not in st.session_state:
-    st.session_state.messages = []
 
 # Title
 st.title("💬 Debt Collection Assistant")
 
 # Clear chat button
 if st.sidebar.button("Clear Conversation", type="primary"):
-    st.session_state.messages = []
     st.session_state.bot.clear_history()
     st.rerun()
 
-# Display chat messages
-for message in st.session_state.messages:
+# Display chat messages, straight from the bot's transcript
+for message in st.session_state.bot.transcript.dialogue():
     with st.chat_message(message["role"]):
         st.write(message["content"])
 
+def queue_turn():
+    # Give each submission its own id once, so a rerun that repeats the
+    # turn replays the stored reply instead of calling the model again
+    st.session_state.pending_turn = (uuid.uuid4().hex, st.session_state.prompt)
+
+
 # Chat input
-if prompt := st.chat_input("Type your message here..."):
+st.chat_input("Type your message here...", key="prompt", on_submit=queue_turn)
+if pending := st.session_state.get("pending_turn"):
+    turn_id, prompt = pending
     # Display user message
     with st.chat_message("user"):
         st.write(prompt)
-    st.session_state.messages.append({"role": "user", "content": prompt})
     
-    # Get and display bot response
+    # Stream the bot response as it is generated
     with st.chat_message("assistant"):
-        with st.spinner("Thinking..."):
-            response = st.session_state.bot.get_response(prompt)
-            st.write(response)
-    st.session_state.messages.append({"role": "assistant", "content": response})
+        st.write_stream(st.session_state.bot.stream_response(prompt, turn_id))
+    del st.session_state.pending_turn
 
 # Sidebar info
 with st.sidebar:
@@ -0,0 +1,161 @@
+"""Offline stand-in for the Anthropic API, for running the bot and the service
+locally and in tests: LLMTransport(registry=FakeRegistry()) never touches
+the network.
+
+Free-form replies come from reply(request), decide-tool calls from
+label(request, labels); both default to simple rules, and tests pass their
+own. Replies stream in small chunks and honour max_tokens, so truncation,
+continuation, cancellation and single flight all behave as upstream.
+"""
+import asyncio
+import json
+from types import SimpleNamespace
+
+
+def default_reply(request):
+    return f"You said: {_last_user_text(request)}"
+
+
+def default_label(request, labels):
+    # The first label named in the debtor's message, else the last one
+    text = _last_user_text(request).lower()
+    return next((label for label in labels if label in text), labels[-1])
+
+
+def _last_user_text(request):
+    for message in reversed(request["messages"]):
+        if message["role"] == "user":
+            return message["content"]
+    return ""
+
+
+def _tokens(text):
+    return -(-len(text) // 4)
+
+
+class FakeRegistry:
+    """Takes the place of llm_client.ClientRegistry.
+
+    requests records every request that reached the fake API, open_streams
+    how many streams are open right now. Exceptions appended to failures are
+    raised by the next streams opened or warm-ups, one each, e.g.
+    anthropic.RateLimitError; those appended to stream_errors are raised
+    by the next streams after their first chunk, like an SSE error event.
+    """
+
+    def __init__(self, reply=None, label=None, delay=0.0, chunk_size=8):
+        self.reply = reply or default_reply
+        self.label = label or default_label
+        self.delay = delay
+        self.chunk_size = chunk_size
+        self.requests = []
+        self.failures = []
+        self.stream_errors = []
+        self.open_streams = 0
+        self.client = SimpleNamespace(messages=_FakeMessages(self), models=_FakeModels())
+
+    def get_client(self, api_key=None):
+        return self.client
+
+    def get_async_client(self, api_key=None):
+        return self.client
+
+    async def awarm_up(self, connections=2, models=(), timeout=None):
+        await asyncio.sleep(self.delay)
+        if self.failures:
+            raise self.failures.pop(0)
+        return {"connections": connections, "primed_models": list(models)}
+
+    def stats(self):
+        return {"requests": len(self.requests), "open_streams": self.open_streams}
+
+
+class _FakeModels:
+    async def list(self, **params):
+        return SimpleNamespace(data=[])
+
+
+class _FakeMessages:
+    def __init__(self, registry):
+        self.registry = registry
+
+    def stream(self, timeout=None, **request):
+        return _FakeStream(self.registry, request)
+
+    async def create(self, timeout=None, **request):
+        async with self.stream(**request) as stream:
+            text = "".join([chunk async for chunk in stream.text_stream])
+        return SimpleNamespace(content=[SimpleNamespace(type="text", text=text)],
+                               stop_reason=stream.current_message_snapshot.stop_reason,
+                               usage=stream.current_message_snapshot.usage)
+
+
+class _FakeStream:
+    # Mirrors the SDK MessageStream: an async context manager, iterated for
+    # events or read through text_stream, with a running message snapshot
+
+    def __init__(self, registry, request):
+        self.registry = registry
+        self.request = request
+        self.opened = False
+        self.closed = False
+        self.sent = 0
+        self.stop_reason = None
+
+    async def __aenter__(self):
+        registry = self.registry
+        registry.requests.append(self.request)
+        await asyncio.sleep(registry.delay)
+        if registry.failures:
+            raise registry.failures.pop(0)
+        self.error = registry.stream_errors.pop(0) if registry.stream_errors else None
+        if self.request.get("tools"):
+            labels = self.request["tools"][0]["input_schema"]["properties"]["label"]["enum"]
+            self.tool = True
+            self.output = json.dumps({"label": registry.label(self.request, labels)})
+        else:
+            self.tool = False
+            self.output = registry.reply(self.request)
+            limit = self.request.get("max_tokens", 1024) * 4
+            self.truncated = len(self.output) > limit
+            self.output = self.output[:limit]
+        self.opened = True
+        registry.open_streams += 1
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if self.opened and not self.closed:
+            self.closed = True
+            self.registry.open_streams -= 1
+
+    async def __aiter__(self):
+        size = self.registry.chunk_size
+        while self.sent < len(self.output):
+            if self.sent and self.error is not None:
+                raise self.error
+            await asyncio.sleep(self.registry.delay / 10)
+            chunk = self.output[self.sent:self.sent + size]
+            self.sent += len(chunk)
+            if self.tool:
+                yield SimpleNamespace(type="input_json", partial_json=chunk)
+            else:
+                yield SimpleNamespace(type="text", text=chunk)
+        if self.tool:
+            self.stop_reason = "tool_use"
+        else:
+            self.stop_reason = "max_tokens" if self.truncated else "end_turn"
+
+    @property
+    def text_stream(self):
+        return self._texts()
+
+    async def _texts(self):
+        async for event in self:
+            yield event.text
+
+    @property
+    def current_message_snapshot(self):
+        prompt = json.dumps([self.request.get("system"), self.request.get("tools"), self.request["messages"]])
+        usage = SimpleNamespace(input_tokens=_tokens(prompt), output_tokens=_tokens(self.output[:self.sent]),
+                                cache_read_input_tokens=0, cache_creation_input_tokens=0)
+        return SimpleNamespace(usage=usage, stop_reason=self.stop_reason)
@@ -0,0 +1,116 @@
+from token_estimator import estimate_tokens
+
+
+class Transcript:
+    """Append-only record of one conversation, every turn stored once.
+
+    Each message is tagged with the agent that handled it (None for lines the
+    bot said itself, such as error fallbacks). Agents read the transcript
+    through ConversationHistory views that share its message objects.
+    """
+
+    __slots__ = ("messages", "agents", "hidden", "cancelled")
+
+    def __init__(self):
+        self.messages = []
+        self.agents = []
+        # Indices of messages the debtor never saw, e.g. handoff sentinels
+        self.hidden = set()
+        # Indices of messages from turns that were cancelled before they finished
+        self.cancelled = set()
+
+    def append(self, agent, role, content, shown=True):
+        message = {"role": role, "content": content}
+        if not shown:
+            self.hidden.add(len(self.messages))
+        self.messages.append(message)
+        self.agents.append(agent)
+        return message
+
+    def cancel(self, start):
+        """Mark every message from index start on as part of a cancelled turn."""
+        self.cancelled.update(range(start, len(self.messages)))
+
+    def last(self, role):
+        for message in reversed(self.messages):
+            if message["role"] == role:
+                return message
+        return None
+
+    def dialogue(self):
+        """The conversation as the debtor saw it, without cancelled turns."""
+        return [message for i, message in enumerate(self.messages) if i not in self.hidden and i not in self.cancelled]
+
+    def entries(self):
+        """Every message with its agent, whether the debtor saw it and whether its
+        turn was cancelled, e.g. for JSON export."""
+        return [
+            {"agent": agent, "role": message["role"], "content": message["content"], "shown": i not in self.hidden,
+             "cancelled": i in self.cancelled}
+            for i, (agent, message) in enumerate(zip(self.agents, self.messages))
+        ]
+
+    def __len__(self):
+        return len(self.messages)
+
+
+class ConversationHistory:
+    """One agent's view of a Transcript, kept within a token budget as it grows.
+
+    The view holds references to the transcript's messages, filtered to the
+    agent's own turns in the roles it sends, plus whatever handoff context it
+    was given with include(). Its list is updated in place, so it can be sent
+    as the request messages without being rebuilt each turn. When the budget
+    is exceeded the oldest turns leave the view (never the transcript),
+    except the first `pinned` messages (the agent's opening exchange) and the
+    latest message.
+    """
+
+    __slots__ = ("transcript", "agent", "token_budget", "pinned", "roles", "messages", "_sizes", "tokens",
+                 "replies", "dropped")
+
+    def __init__(self, transcript, agent=None, token_budget=1000, roles=("user", "assistant"), pinned=None):
+        self.transcript = transcript
+        self.agent = agent
+        self.token_budget = token_budget
+        self.pinned = len(roles) if pinned is None else pinned
+        self.roles = roles
+        self.clear()
+
+    def append(self, role, content, shown=True):
+        message = self.transcript.append(self.agent, role, content, shown)
+        if role == "assistant":
+            self.replies += 1
+        if role in self.roles:
+            self.include(message)
+        return message
+
+    def include(self, message):
+        # Add a message to the view without recording a new turn
+        size = estimate_tokens(message["content"])
+        self.messages.append(message)
+        self._sizes.append(size)
+        self.tokens += size
+        self._enforce_budget()
+
+    def _enforce_budget(self):
+        # Drop whole turns (one message per kept role) so roles keep alternating
+        step = len(self.roles)
+        while self.tokens > self.token_budget and len(self.messages) > self.pinned + step:
+            del self.messages[self.pinned:self.pinned + step]
+            self.tokens -= sum(self._sizes[self.pinned:self.pinned + step])
+            del self._sizes[self.pinned:self.pinned + step]
+            self.dropped += step
+
+    def pop(self):
+        # Take the latest message out of the view, e.g. a debtor turn that never
+        # got a reply; the transcript still records that it was said
+        self.tokens -= self._sizes.pop()
+        return self.messages.pop()
+
+    def clear(self):
+        self.messages = []
+        self._sizes = []
+        self.tokens = 0
+        self.replies = 0
+        self.dropped = 0
@@ -1,41 +1,472 @@
-import anthropic
-import os
+import asyncio
+import re
+import time
+from collections import OrderedDict
 from datetime import datetime
-#MODEL_ID = "claude-3-5-haiku-latest"
+
+from history import ConversationHistory, Transcript
+from llm_client import iter_sync, run_sync, warm_up
+from rate_limiter import LIVE, PREFETCH
+from response_cache import get_response_cache, get_similarity_cache, request_key
+from scripts import ScriptRenderer
+from token_estimator import get_output_budget, get_token_estimator
+from transport import LLMError, LLMUnavailable, get_transport
 MODEL_ID = "claude-3-5-sonnet-latest"
+FAST_MODEL_ID = "claude-3-5-haiku-latest"
+
+# Model per agent and turn type: "opening" is the agent's first reply,
+# "follow_up" any later one, and "default" covers what is not listed.
+# Routing and verification decisions go to the fast model; free-form
+# objection handling in the discussion gets the larger one.
+MODEL_POLICY = {
+    "InitialAgent": {"default": FAST_MODEL_ID},
+    "VerificationAgent": {"default": FAST_MODEL_ID},
+    "DiscussionAgent": {"opening": FAST_MODEL_ID, "decision": FAST_MODEL_ID, "follow_up": MODEL_ID},
+    "AppointmentBookingAgent": {"default": FAST_MODEL_ID},
+}
+TRANSFER_PREFIX = "TRANSFER_TO_"
+
+def configured_models():
+    # Every model MODEL_POLICY can route to, for warming up
+    return sorted({MODEL_ID}.union(*(policy.values() for policy in MODEL_POLICY.values())))
+
+# Output cap for decision calls; a forced tool call with one short label fits easily
+DECISION_MAX_TOKENS = 24
+# Follow-up requests allowed for a reply that ran into its max_tokens
+MAX_CONTINUATIONS = 2
+# Finished turns per conversation whose replies are kept for repeated submissions
+MAX_STORED_TURNS = 32
+_LABEL = re.compile(r'"label"\s*:\s*"([^"]*)')
+
+def _releasable(text):
+    # Length of text that can be shown without risking a partial TRANSFER_TO_ sentinel
+    cut = len(text)
+    for n in range(min(len(TRANSFER_PREFIX), len(text)), 0, -1):
+        if TRANSFER_PREFIX.startswith(text[-n:]):
+            cut = len(text) - n
+            break
+    return len(text[:cut].rstrip(' "\n'))
+
+def _new_usage():
+    return {
+        "input_tokens": 0,
+        "output_tokens": 0,
+        "cache_read_input_tokens": 0,
+        "cache_creation_input_tokens": 0,
+        "first_token_seconds": 0.0,
+        "timed_calls": 0,
+    }
+
+class AgentState:
+    """What one conversation has built up with one agent: its history and counters."""
+
+    __slots__ = ("session", "history", "llm_calls", "scripted_replies", "cached_replies", "similar_replies",
+                 "decision_calls", "speculations_used", "speculations_wasted", "speculation_saved_seconds",
+                 "truncated_replies", "continuations", "usage")
+
+    def __init__(self, session, agent):
+        # session is the owning MultiAgentDebtCollectionBot: transport, scripts, transcript
+        self.session = session
+        self.history = ConversationHistory(session.transcript, agent.name, agent.history_budget, agent.history_roles)
+        self.llm_calls = 0
+        self.scripted_replies = 0
+        self.cached_replies = 0
+        self.similar_replies = 0
+        self.decision_calls = 0
+        self.speculations_used = 0
+        self.speculations_wasted = 0
+        self.speculation_saved_seconds = 0.0
+        self.truncated_replies = 0
+        self.continuations = 0
+        self.usage = _new_usage()
+
+    @property
+    def conversation_history(self):
+        return self.history.messages
 
 class BaseAgent:
+    """Agent definition: prompt, model parameters and transitions.
+
+    One instance of each agent is shared by every conversation (see AGENTS),
+    so nothing here may change after import; whatever a conversation builds
+    up with an agent lives in the AgentState passed to each call.
+    """
+
+    # Key in AGENTS
+    name = None
+    # Sentinels this agent may answer with, and the agent each hands off to;
+    # the stream is cut as soon as one appears
+    handoffs = {}
+    # Handing off to this agent ends the conversation
+    ends_conversation = False
+    # Reached only after the debtor was verified; such conversations are never
+    # shed by admission control
+    verified = False
+    # After a handoff the agent's view starts with the debtor turn that
+    # triggered it; otherwise with the shared "Start <name>" opener, so earlier
+    # agents' turns are never re-sent
+    handoff_context = False
+    # Script lines rendered locally instead of calling the model:
+    # opening_script for the agent's first reply, script for every reply
+    opening_script = None
+    script = None
+    # Serve repeated identical requests from the shared exact-response cache
+    cache_responses = False
+    # Minimum n-gram similarity for reusing the free-form reply to a
+    # near-identical debtor turn in the same conversation state; None disables
+    # it. Decisions are never reused this way, so it only pays off for agents
+    # whose turns can fall through to a free-form reply
+    similarity_threshold = None
+    # Roles sent back to the model, and the token budget for what is sent
+    history_roles = ("user",)
+    history_budget = 1000
+    # Decision mode: {label: (description, outcome)}. The model only picks a
+    # label through a forced tool call; the outcome is a TRANSFER_TO_ sentinel,
+    # a script line name, or None to fall back to a free-form reply
+    decisions = None
+    # Words hinting at a scripted decision label. With speculative on, a turn
+    # without any of them starts the free-form reply during the decision call
+    decision_keywords = ()
+
     def __init__(self, system_prompt):
-        self.client = anthropic.Anthropic(api_key=os.getenv("ANTHROPIC_API_KEY"))
         self.system_prompt = system_prompt
-        self.conversation_history = []
+        self.opener = {"role": "user", "content": f"Start {self.name}"}
 
-    def get_response(self, user_input):
-        self.conversation_history.append({"role": "user", "content": user_input})
-        
+    def get_response(self, state, user_input):
+        return run_sync(self.aget_response(state, user_input))
+
+    def stream_response(self, state, user_input):
+        return iter_sync(self.astream_response(state, user_input))
+
+    async def aget_response(self, state, user_input):
+        return "".join([text async for text in self.astream_response(state, user_input)])
+
+    def astream_response(self, state, user_input):
+        state.history.append("user", user_input)
+        return self._respond(state, user_input)
+
+    def astream_handoff(self, state, trigger):
+        # The agent's first turn after a handoff; trigger is the debtor's message
+        # in the transcript that led to it
+        message = trigger if self.handoff_context else self.opener
+        state.history.include(message)
+        return self._respond(state, message["content"])
+
+    async def _respond(self, state, user_input):
+        script = self._script_for(state, user_input)
+        if script:
+            bot_response = state.session.scripts.render(script)
+            state.scripted_replies += 1
+            self._finish(state, bot_response)
+            yield bot_response
+            return
+
+        # Exact cache entries are (outcome, reply): a decision outcome, rendered
+        # for each conversation's own debtor, or a free-form reply, which only
+        # depends on the request the key was made from. The similarity cache
+        # only ever holds free-form replies: a near match is no reason to route
+        # the conversation the way an earlier debtor's words did
+        request = self._request(state)
+        cache_key = request_key(type(self).__name__, request) if self.cache_responses else None
+        cached = cache_key and get_response_cache().get(cache_key)
+        if cached:
+            state.cached_replies += 1
+            bot_response = self._from_cache(state, cached)
+            self._finish(state, bot_response)
+            yield bot_response
+            return
+
+        state_key = None
+        if self.similarity_threshold:
+            state_key = request_key(type(self).__name__, dict(request, messages=request["messages"][:-1]))
+            similar = get_similarity_cache().lookup(state_key, user_input, self.similarity_threshold)
+            if similar:
+                state.similar_replies += 1
+                self._finish(state, similar)
+                yield similar
+                return
+
+        speculation = None
+        if state.session.speculative and self._likely_free_form(user_input):
+            speculation = self._speculate(state, request)
         try:
-            message = self.client.messages.create(
-                model=f"{MODEL_ID}",
-                max_tokens=150,
-                temperature=0.2,
-                system=self.system_prompt,
-                messages=[
-                    {"role": m["role"], "content": m["content"]} 
-                    for m in self.conversation_history if m["role"] == "user"
-                ]
-            )
-            
-            bot_response = message.content[0].text
-            self.conversation_history.append({"role": "assistant", "content": bot_response})
-            return bot_response
-            
-        except Exception as e:
-            return f"An error occurred: {str(e)}"
+            outcome = await self._decide(state, request) if self.decisions else None
+        except BaseException:
+            # Failed, or cancelled by a newer turn
+            if speculation:
+                speculation[1].cancel()
+            state.history.pop()
+            raise
+        if outcome is not None:
+            if speculation:
+                speculation[1].cancel()
+                state.speculations_wasted += 1
+            if cache_key:
+                get_response_cache().put(cache_key, (outcome, None))
+            bot_response = self._render(state, outcome)
+            self._finish(state, bot_response)
+            yield bot_response
+            return
 
-    def clear_history(self):
-        self.conversation_history = []
+        bot_response = ""
+        try:
+            async for text in self._speculated(state, speculation) if speculation else self._generate(state, request):
+                bot_response += text
+                yield text
+        except BaseException:
+            # Failed, cancelled or abandoned: forget the unanswered turn so the
+            # debtor can simply say it again
+            state.history.pop()
+            raise
+
+        if cache_key:
+            get_response_cache().put(cache_key, (None, bot_response))
+        if state_key and not self._handoff_in(bot_response):
+            get_similarity_cache().put(state_key, user_input, bot_response)
+        self._finish(state, bot_response)
+
+    def _from_cache(self, state, entry):
+        outcome, reply = entry
+        return reply if outcome is None else self._render(state, outcome)
+
+    def _render(self, state, outcome):
+        # A script name or a TRANSFER_TO_ sentinel, which is passed on as is
+        if outcome.startswith(TRANSFER_PREFIX):
+            return outcome
+        return state.session.scripts.render(outcome)
+
+    async def _generate(self, state, request, priority=LIVE):
+        # Free-form reply, streamed, and continued where it runs into max_tokens
+        bot_response = ""
+        output_tokens = 0
+        session = state.session
+        for continuation in range(MAX_CONTINUATIONS + 1):
+            if continuation:
+                state.continuations += 1
+            state.llm_calls += 1
+            turn_request = self._continuation_request(request, bot_response) if continuation else request
+            estimated = get_token_estimator().estimate_request(turn_request)
+            start = time.perf_counter()
+            first_token = None
+            async with session.transport.stream(turn_request, hedge_budget=session.hedge_budget, priority=priority,
+                                                estimated_tokens=estimated) as stream:
+                async for text in stream.text_stream:
+                    if first_token is None:
+                        first_token = time.perf_counter() - start
+                    bot_response += text
+                    yield text
+                    # Leaving the stream context closes the connection, which stops
+                    # the generation instead of paying for the rest of the reply
+                    if self._handoff_in(bot_response):
+                        break
+                # Input and cache usage arrive with message_start, so this is
+                # complete even when the stream was cut short
+                self._record_usage(state, stream.usage, first_token)
+                self._record_call(state, turn_request, stream, first_token, time.perf_counter() - start, estimated)
+                output_tokens += stream.usage.output_tokens or 0
+                stop_reason = stream.stop_reason
+            if stop_reason != "max_tokens":
+                break
+            if not continuation:
+                state.truncated_replies += 1
+        get_output_budget().observe(self.name, self._turn_type(state), output_tokens, continuation > 0)
+
+    def _continuation_request(self, request, partial):
+        # Prefill the reply so far; the model carries on from where it stopped.
+        # Prefills may not end in whitespace
+        messages = request["messages"] + [{"role": "assistant", "content": partial.rstrip()}]
+        return dict(request, messages=messages)
+
+    def _likely_free_form(self, user_input):
+        # Only worth speculating when a label can fall through to free-form
+        # and nothing in the turn hints at one of the scripted labels
+        if not self.decisions or all(outcome is not None for _, outcome in self.decisions.values()):
+            return False
+        text = user_input.lower()
+        return not any(keyword in text for keyword in self.decision_keywords)
+
+    def _speculate(self, state, request):
+        # Start the free-form reply alongside the decision call, queueing its
+        # chunks until the decision says whether it is needed
+        queue = asyncio.Queue()
+
+        async def run():
+            try:
+                # Queued behind live calls at the rate limiter; it may be thrown away
+                async for text in self._generate(state, request, PREFETCH):
+                    queue.put_nowait(text)
+            except Exception as e:
+                # Any failure must reach the reply waiting on the queue, or it waits forever
+                queue.put_nowait(e)
+                return
+            queue.put_nowait(None)
+
+        return queue, asyncio.ensure_future(run()), time.perf_counter()
+
+    async def _speculated(self, state, speculation):
+        queue, task, started = speculation
+        state.speculations_used += 1
+        state.speculation_saved_seconds += time.perf_counter() - started
+        try:
+            while True:
+                item = await queue.get()
+                if item is None:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            task.cancel()
+
+    async def _decide(self, state, request):
+        # Returns the outcome for the chosen label (a script name or a
+        # TRANSFER_TO_ sentinel), or None for a free-form turn
+        state.llm_calls += 1
+        state.decision_calls += 1
+        request = self._decision_request(state, request)
+        partial_json = ""
+        label = None
+        estimated = get_token_estimator().estimate_request(request)
+        start = time.perf_counter()
+        first_token = None
+        session = state.session
+        async with session.transport.stream(request, hedge_budget=session.hedge_budget, events=True,
+                                            estimated_tokens=estimated) as stream:
+            async for event in stream.events:
+                if event.type != "input_json":
+                    continue
+                if first_token is None:
+                    first_token = time.perf_counter() - start
+                partial_json += event.partial_json
+                label = self._label_from(partial_json)
+                if label:
+                    # No need to wait for the rest of the JSON once the label is settled
+                    break
+            self._record_usage(state, stream.usage, first_token)
+            self._record_call(state, request, stream, first_token, time.perf_counter() - start, estimated,
+                              "decision")
+        if label is None:
+            return None
+        return self.decisions[label][1]
+
+    def _decision_request(self, state, request):
+        labels = "\n".join(f"{label}: {description}" for label, (description, _) in self.decisions.items())
+        system = request["system"] + [{
+            "type": "text",
+            "text": "Do not reply to the debtor. Classify their latest message by calling the decide tool.",
+        }]
+        tool = {
+            "name": "decide",
+            "description": "Record which case the debtor's latest message falls under.",
+            "input_schema": {
+                "type": "object",
+                "properties": {"label": {"type": "string", "enum": list(self.decisions), "description": labels}},
+                "required": ["label"],
+            },
+        }
+        return dict(
+            request,
+            model=self._model(state, "decision"),
+            max_tokens=DECISION_MAX_TOKENS,
+            temperature=0,
+            system=system,
+            tools=[tool],
+            tool_choice={"type": "tool", "name": "decide"},
+        )
+
+    def _label_from(self, partial_json):
+        # Labels are chosen to differ early, so a prefix of the streamed JSON settles them
+        match = _LABEL.search(partial_json)
+        if not match or not match.group(1):
+            return None
+        candidates = [label for label in self.decisions if label.startswith(match.group(1))]
+        return candidates[0] if len(candidates) == 1 else None
+
+    def _finish(self, state, bot_response):
+        state.history.append("assistant", bot_response, shown=not self._handoff_in(bot_response))
+
+    def _script_for(self, state, user_input):
+        if self.script:
+            return self.script
+        if self.opening_script and not state.history.replies:
+            return self.opening_script
+        return None
+
+    def _handoff_in(self, text):
+        return any(sentinel in text for sentinel in self.handoffs)
+
+    def _turn_type(self, state):
+        return "follow_up" if state.history.replies else "opening"
+
+    def _model(self, state, turn_type=None):
+        policy = MODEL_POLICY.get(type(self).__name__, {})
+        return policy.get(turn_type or self._turn_type(state), policy.get("default", MODEL_ID))
+
+    def _request(self, state):
+        return dict(
+            model=self._model(state),
+            max_tokens=get_output_budget().get(self.name, self._turn_type(state)),
+            temperature=0.2,
+            system=self._system(state),
+            messages=self._messages(state)
+        )
+
+    def _system(self, state):
+        # The stable prompt is the cached prefix; per-turn context goes after the breakpoint
+        blocks = [{"type": "text", "text": self.system_prompt, "cache_control": {"type": "ephemeral"}}]
+        context_prompt = self._context_prompt(state)
+        if context_prompt:
+            blocks.append({"type": "text", "text": context_prompt})
+        return blocks
+
+    def _context_prompt(self, state):
+        return None
+
+    def _record_usage(self, state, usage, first_token):
+        state.usage["input_tokens"] += usage.input_tokens or 0
+        state.usage["output_tokens"] += usage.output_tokens or 0
+        state.usage["cache_read_input_tokens"] += getattr(usage, "cache_read_input_tokens", None) or 0
+        state.usage["cache_creation_input_tokens"] += getattr(usage, "cache_creation_input_tokens", None) or 0
+        if first_token is not None:
+            state.usage["first_token_seconds"] += first_token
+            state.usage["timed_calls"] += 1
+
+    def _record_call(self, state, request, stream, first_token, latency, estimated, turn_type=None):
+        # Prompt tokens the API counted, cached or not, to calibrate the local estimate against
+        usage = stream.usage
+        actual = (usage.input_tokens or 0) + (getattr(usage, "cache_read_input_tokens", None) or 0) \
+            + (getattr(usage, "cache_creation_input_tokens", None) or 0)
+        if not stream.collapsed:
+            # A joiner reports the usage of the call it joined; learn from that call once
+            get_token_estimator().observe(estimated, actual)
+        state.session.transport.record_call({
+            "agent": type(self).__name__,
+            "turn_type": turn_type or self._turn_type(state),
+            "model": request["model"],
+            "first_token_seconds": first_token,
+            "latency_seconds": latency,
+            "input_tokens": usage.input_tokens or 0,
+            "output_tokens": usage.output_tokens or 0,
+            "cache_read_input_tokens": getattr(usage, "cache_read_input_tokens", None) or 0,
+            "estimated_input_tokens": estimated,
+            # Served by an identical call already in flight; its tokens were paid for once
+            "collapsed": stream.collapsed,
+        })
+
+    def _messages(self, state):
+        return state.history.messages
 
 class InitialAgent(BaseAgent):
+    name = "initial"
+    handoffs = {"TRANSFER_TO_VERIFICATION": "verification", "TRANSFER_TO_SORRY": "sorry"}
+    opening_script = "greeting"
+    cache_responses = True
+    history_roles = ("user", "assistant")
+    decisions = {
+        "confirmed": ("The person confirms in any way that they are the person asked for", "TRANSFER_TO_VERIFICATION"),
+        "not_confirmed": ("The person denies it or seems unsure", "TRANSFER_TO_SORRY"),
+    }
+
     def __init__(self):
         system_prompt = """You are a debt collection agent making initial contact. 
         For your first message, begin with: "Good morning/Afternoon/Evening Sir/Miss/Mdm. My name is Alex calling from Credence Bank and I would like to speak with John Doe."
@@ -44,35 +475,18 @@ class InitialAgent(BaseAgent):
         If they deny or seem unsure respond with: "TRANSFER_TO_SORRY"
         Be professional and courteous at all times. Stick to the Script as much as possible"""
         super().__init__(system_prompt)
-        self.confirmation_attempts = 0
-
-    def get_response(self, user_input):
-        self.conversation_history.append({"role": "user", "content": user_input})
-        
-        try:
-            message = self.client.messages.create(
-                model=f"{MODEL_ID}",
-                max_tokens=150,
-                temperature=0.2,
-                system=self.system_prompt,
-                messages=self.conversation_history
-            )
-            
-            bot_response = message.content[0].text
-            
-            # Let the LLM determine if identity is confirmed through its response
-            '''if "TRANSFER_TO_VERIFICATION" not in bot_response:
-                self.confirmation_attempts += 1
-                if self.confirmation_attempts >= 2:
-                    bot_response = "TRANSFER_TO_SORRY"'''
-            
-            self.conversation_history.append({"role": "assistant", "content": bot_response})
-            return bot_response
-            
-        except Exception as e:
-            return f"An error occurred: {str(e)}"
 
 class VerificationAgent(BaseAgent):
+    name = "verification"
+    handoffs = {"TRANSFER_TO_DISCUSSION": "discussion", "TRANSFER_TO_SORRY": "sorry"}
+    opening_script = "verification_request"
+    cache_responses = True
+    history_roles = ("user", "assistant")
+    decisions = {
+        "verified": ("The person provided any 4 digits or a date of birth", "TRANSFER_TO_DISCUSSION"),
+        "failed": ("The person did not provide proper verification information", "TRANSFER_TO_SORRY"),
+    }
+
     def __init__(self):
         system_prompt = """You are a verification agent.
         When you first start, say: "To ensure I am speaking with the correct person, may I confirm your last 4 digits of your IC number or Date of Birth please?"
@@ -81,26 +495,25 @@ class VerificationAgent(BaseAgent):
         Be professional and courteous at all times. Stick to the Script as much as possible"""
         super().__init__(system_prompt)
 
-    def get_response(self, user_input):
-        self.conversation_history.append({"role": "user", "content": user_input})
-        
-        try:
-            message = self.client.messages.create(
-                model=f"{MODEL_ID}",
-                max_tokens=150,
-                temperature=0.2,
-                system=self.system_prompt,
-                messages=self.conversation_history
-            )
-            
-            bot_response = message.content[0].text
-            self.conversation_history.append({"role": "assistant", "content": bot_response})
-            return bot_response
-            
-        except Exception as e:
-            return f"An error occurred: {str(e)}"
-
 class DiscussionAgent(BaseAgent):
+    name = "discussion"
+    verified = True
+    handoffs = {"TRANSFER_TO_CLOSURE": "closure", "TRANSFER_TO_APPOINTMENT": "appointment"}
+    opening_script = "discussion_intro"
+    cache_responses = True
+    similarity_threshold = 0.85
+    history_roles = ("user", "assistant")
+    history_budget = 2000
+    decisions = {
+        "balance": ("Asks about their current outstanding balance or the amount owed", "balance"),
+        "plans": ("Asks to know about the payment plans", "payment_plans"),
+        "interested": ("Expresses interest in either of the payment plans", "TRANSFER_TO_CLOSURE"),
+        "callback": ("Requests a callback or to discuss the plans later or at a different time", "TRANSFER_TO_APPOINTMENT"),
+        "other": ("Anything else", None),
+    }
+    decision_keywords = ("balance", "owe", "amount", "how much", "plan", "option", "interest",
+                         "ok", "yes", "sure", "later", "call back", "callback", "busy")
+
     def __init__(self):
         system_prompt = """You are a debt collection agent providing account information.
         IF THIS IS YOUR FIRST MESSAGE IN THE CONVERSATION:
@@ -121,33 +534,15 @@ class DiscussionAgent(BaseAgent):
         
         Be professional, understanding, and helpful. Stick to the Script as much as possible"""
         super().__init__(system_prompt)
-        self.initial_greeting_sent = False
 
-    def get_response(self, user_input):
-        self.conversation_history.append({"role": "user", "content": user_input})
-        
-        try:
-            context_prompt = "THIS IS YOUR FIRST MESSAGE" if not self.initial_greeting_sent else "THIS IS A FOLLOW-UP MESSAGE"
-            message = self.client.messages.create(
-                model=f"{MODEL_ID}",
-                max_tokens=150,
-                temperature=0.2,
-                system=f"{self.system_prompt}\n{context_prompt}",
-                messages=self.conversation_history
-            )
-            
-            bot_response = message.content[0].text
-            self.conversation_history.append({"role": "assistant", "content": bot_response})
-            
-            if not self.initial_greeting_sent:
-                self.initial_greeting_sent = True
-                
-            return bot_response
-            
-        except Exception as e:
-            return f"An error occurred: {str(e)}"
+    def _context_prompt(self, state):
+        return "THIS IS YOUR FIRST MESSAGE" if not state.history.replies else "THIS IS A FOLLOW-UP MESSAGE"
 
 class SorryAgent(BaseAgent):
+    name = "sorry"
+    script = "sorry"
+    ends_conversation = True
+
     def __init__(self):
         system_prompt = """You are a debt collection agent handling unexpected scenarios.
         When you start, say: "I apologize, but I haven't been programmed to handle this situation yet. 
@@ -156,6 +551,11 @@ class SorryAgent(BaseAgent):
         super().__init__(system_prompt)
 
 class ClosureAgent(BaseAgent):
+    name = "closure"
+    verified = True
+    script = "closure"
+    ends_conversation = True
+
     def __init__(self):
         system_prompt = """You are a debt collection agent handling call closure.
         When you start, say: "Thank you for your cooperation and I will be connecting this call to the Credit Management officer that in charge of your account for further discussion. Please hold the line and at the same time you will receive a SMS notification with the detail of the Person In charge and contact detail to call back if this line is disconnected during the transfer of this call."
@@ -163,6 +563,19 @@ class ClosureAgent(BaseAgent):
         super().__init__(system_prompt)
 
 class AppointmentBookingAgent(BaseAgent):
+    name = "appointment"
+    verified = True
+    opening_script = "appointment_request"
+    cache_responses = True
+    history_roles = ("user", "assistant")
+    decisions = {
+        "time_given": ("Provides any date or time information", "appointment_confirmed"),
+        "other": ("Anything else", None),
+    }
+    handoff_context = True
+    decision_keywords = ("today", "tomorrow", "morning", "afternoon", "evening", "monday", "tuesday",
+                         "wednesday", "thursday", "friday", "saturday", "sunday", "week") + tuple("0123456789")
+
     def __init__(self):
         system_prompt = """You are a debt collection agent handling appointment scheduling.
         When you first start, say: "We have noted your request for a call back and would like to confirm your preferred date and time for the discussion."
@@ -172,94 +585,224 @@ class AppointmentBookingAgent(BaseAgent):
         
         Stick to the Script exactly as written."""
         super().__init__(system_prompt)
-        self.initial_request_sent = False
 
-    def get_response(self, user_input):
-        self.conversation_history.append({"role": "user", "content": user_input})
-        
-        try:
-            context_prompt = "THIS IS YOUR FIRST MESSAGE" if not self.initial_request_sent else "THIS IS A FOLLOW-UP MESSAGE"
-            message = self.client.messages.create(
-                model=f"{MODEL_ID}",
-                max_tokens=150,
-                temperature=0.2,
-                system=f"{self.system_prompt}\n{context_prompt}",
-                messages=self.conversation_history
-            )
-            
-            bot_response = message.content[0].text
-            self.conversation_history.append({"role": "assistant", "content": bot_response})
-            
-            if not self.initial_request_sent:
-                self.initial_request_sent = True
-                
-            return bot_response
-            
-        except Exception as e:
-            return f"An error occurred: {str(e)}"
+    def _context_prompt(self, state):
+        return "THIS IS YOUR FIRST MESSAGE" if not state.history.replies else "THIS IS A FOLLOW-UP MESSAGE"
+
+# Shared agent definitions, keyed by name
+AGENTS = {agent.name: agent for agent in (
+    InitialAgent(),
+    VerificationAgent(),
+    DiscussionAgent(),
+    SorryAgent(),
+    ClosureAgent(),
+    AppointmentBookingAgent(),
+)}
 
 class MultiAgentDebtCollectionBot:
-    def __init__(self):
-        self.initial_agent = InitialAgent()
-        self.verification_agent = VerificationAgent()
-        self.discussion_agent = DiscussionAgent()
-        self.sorry_agent = SorryAgent()
-        self.closure_agent = ClosureAgent()
-        self.appointment_booking_agent = AppointmentBookingAgent()
-        self.current_agent = self.initial_agent
-        self.identity_confirmed = False
-        self.verification_complete = False
-        self.conversation_ended = False
+    """One conversation. The agents are the shared AGENTS; this record only
+    holds the conversation's own state, so it stays a few kilobytes."""
+
+    __slots__ = ("transport", "scripts", "speculative", "hedge_budget", "current_agent", "conversation_ended",
+                 "transcript", "states", "turns", "dedupe_hits", "handoff_timings", "last_error")
+
+    def __init__(self, transport=None, debtor=None, speculative=False):
+        self.transport = transport or get_transport()
+        self.scripts = ScriptRenderer(debtor)
+        self.speculative = speculative
+        self.clear_history()
+
+    def get_response(self, user_input, turn_id=None):
+        return run_sync(self.aget_response(user_input, turn_id))
+
+    def stream_response(self, user_input, turn_id=None):
+        return iter_sync(self.astream_response(user_input, turn_id))
+
+    async def aget_response(self, user_input, turn_id=None):
+        return "".join([delta async for delta in self.astream_response(user_input, turn_id)])
 
-    def get_response(self, user_input):
+    async def astream_response(self, user_input, turn_id=None):
+        # With a turn_id, submitting the same turn again (a rerun, double click
+        # or client retry) replays the stored reply instead of running it again
+        if turn_id is not None and turn_id in self.turns:
+            self.dedupe_hits += 1
+            yield self.turns[turn_id]
+            return
+        if not self.conversation_ended:
+            admission = await self.transport.admission.aadmit(protected=self.current_agent.verified)
+            if not admission["admitted"]:
+                # Shed under load before any LLM call; not stored, so a retry of
+                # the same turn_id runs it for real
+                self.transcript.append(None, "user", user_input)
+                yield self._say(self.scripts.render("busy"))
+                return
+        reply = ""
+        try:
+            async for delta in self._astream_turn(user_input):
+                reply += delta
+                yield delta
+        except LLMError as e:
+            # Not stored either: a retry of the turn should reach the model again
+            yield self._fallback(e)
+            return
+        if turn_id is not None:
+            self.turns[turn_id] = reply
+            if len(self.turns) > MAX_STORED_TURNS:
+                self.turns.popitem(last=False)
+
+    async def _astream_turn(self, user_input):
         if self.conversation_ended:
-            return "The conversation has ended. Type 'clear' to start a new conversation."
-            
-        response = self.current_agent.get_response(user_input)
-        
-        # Check for transfers
-        if not self.identity_confirmed and "TRANSFER_TO_VERIFICATION" in response:
-            self.identity_confirmed = True
-            self.current_agent = self.verification_agent
-            return self.verification_agent.get_response("Start verification")
-        
-        if not self.verification_complete and "TRANSFER_TO_DISCUSSION" in response:
-            self.verification_complete = True
-            self.current_agent = self.discussion_agent
-            return self.discussion_agent.get_response("Start discussion")
-
-        if "TRANSFER_TO_SORRY" in response:
-            self.current_agent = self.sorry_agent
-            self.conversation_ended = True
-            return self.sorry_agent.get_response("Start sorry")
-            
-        if "TRANSFER_TO_CLOSURE" in response:
-            self.current_agent = self.closure_agent
-            self.conversation_ended = True
-            return self.closure_agent.get_response("Start closure")
-            
-        if "TRANSFER_TO_APPOINTMENT" in response:
-            self.current_agent = self.appointment_booking_agent
-            return self.appointment_booking_agent.get_response("Start appointment")
-            
-        return response
+            self.transcript.append(None, "user", user_input)
+            yield self._say("The conversation has ended. Type 'clear' to start a new conversation.")
+            return
+
+        # Hold back anything that could be the start of a TRANSFER_TO_ sentinel, so
+        # on a handoff the user only ever sees the next agent's stream
+        agent = self.current_agent
+        start = last_delta = time.perf_counter()
+        turn_start = len(self.transcript)
+        response = ""
+        released = 0
+        shown = ""
+        stream = agent.astream_response(self.state(agent), user_input)
+        try:
+            async for delta in stream:
+                last_delta = time.perf_counter()
+                response += delta
+                if TRANSFER_PREFIX in response:
+                    continue
+                end = _releasable(response)
+                if end > released:
+                    shown += response[released:end]
+                    yield response[released:end]
+                    released = end
+            closed = time.perf_counter()
+
+            next_agent = self._handoff(response)
+            if next_agent:
+                first_token = None
+                trigger = self.transcript.last("user")
+                stream = next_agent.astream_handoff(self.state(next_agent), trigger)
+                async for delta in stream:
+                    if first_token is None:
+                        first_token = time.perf_counter()
+                    shown += delta
+                    yield delta
+                self._record_handoff(agent, next_agent, start, last_delta, closed, first_token)
+            elif released < len(response):
+                yield response[released:]
+        except (asyncio.CancelledError, GeneratorExit):
+            # Superseded by a newer turn, or the reader went away. Close the agent's
+            # stream now, so it forgets the turn before the next one starts
+            await stream.aclose()
+            self._record_cancelled(turn_start, shown)
+            raise
+
+    def state(self, agent):
+        # Created on first use; most conversations never meet every agent
+        state = self.states.get(agent.name)
+        if state is None:
+            state = self.states[agent.name] = AgentState(self, agent)
+        return state
+
+    def _fallback(self, error):
+        # Never read an error out to the debtor; say a script line and stay in place
+        self.last_error = error
+        if isinstance(error, LLMUnavailable):
+            return self._say(self.scripts.render("technical_outage"))
+        return self._say(self.scripts.render("technical_retry"))
+
+    def _record_cancelled(self, turn_start, shown):
+        # The transcript keeps the cancelled turn, including any reply the debtor
+        # already saw part of, marked as cancelled
+        if shown:
+            self.transcript.append(self.current_agent.name, "assistant", shown)
+        self.transcript.cancel(turn_start)
+
+    def _say(self, text):
+        # Lines from the bot itself rather than an agent
+        self.transcript.append(None, "assistant", text)
+        return text
+
+    def _record_handoff(self, agent, next_agent, start, detected, closed, first_token):
+        # Seconds from the start of the turn; the gap between sentinel_at and
+        # stream_closed_at is what is left of the aborted generation
+        self.handoff_timings.append({
+            "from": type(agent).__name__,
+            "to": type(next_agent).__name__,
+            "sentinel_at": detected - start,
+            "stream_closed_at": closed - start,
+            "next_first_token_at": (first_token or time.perf_counter()) - start,
+            "turn_total": time.perf_counter() - start,
+        })
+
+    def _handoff(self, response):
+        # Check for transfers; returns the next agent
+        for sentinel, name in self.current_agent.handoffs.items():
+            if sentinel in response:
+                self.current_agent = AGENTS[name]
+                self.conversation_ended = self.current_agent.ends_conversation
+                return self.current_agent
+        return None
+
+    def call_stats(self):
+        # LLM calls made versus avoided by script lines and the response cache
+        states = self.states.values()
+        scripted = sum(state.scripted_replies for state in states)
+        cached = sum(state.cached_replies for state in states)
+        similar = sum(state.similar_replies for state in states)
+        return {
+            "llm_calls": sum(state.llm_calls for state in states),
+            "llm_calls_avoided": scripted + cached + similar,
+            "scripted_replies": scripted,
+            "cached_replies": cached,
+            "similar_replies": similar,
+            "decision_calls": sum(state.decision_calls for state in states),
+            "speculations_used": sum(state.speculations_used for state in states),
+            "speculations_wasted": sum(state.speculations_wasted for state in states),
+            "speculation_saved_seconds": sum(state.speculation_saved_seconds for state in states),
+            "truncated_replies": sum(state.truncated_replies for state in states),
+            "continuations": sum(state.continuations for state in states),
+            "dedupe_hits": self.dedupe_hits,
+        }
+
+    def cache_report(self):
+        # Per agent prompt-cache reads versus writes and mean time to first token
+        report = {}
+        for name, state in self.states.items():
+            usage = state.usage
+            cached = usage["cache_read_input_tokens"]
+            total_input = usage["input_tokens"] + cached + usage["cache_creation_input_tokens"]
+            report[type(AGENTS[name]).__name__] = {
+                "cache_read_tokens": cached,
+                "cache_write_tokens": usage["cache_creation_input_tokens"],
+                "uncached_input_tokens": usage["input_tokens"],
+                "cache_hit_rate": cached / total_input if total_input else 0.0,
+                "mean_first_token_seconds": usage["first_token_seconds"] / usage["timed_calls"] if usage["timed_calls"] else None,
+            }
+        return report
 
     def clear_history(self):
-        self.initial_agent.clear_history()
-        self.verification_agent.clear_history()
-        self.discussion_agent.clear_history()
-        self.sorry_agent.clear_history()
-        self.closure_agent.clear_history()
-        self.appointment_booking_agent.clear_history()
-        self.current_agent = self.initial_agent
-        self.identity_confirmed = False
-        self.verification_complete = False
+        # Hedged duplicate requests are capped per conversation
+        self.hedge_budget = self.transport.new_hedge_budget()
+        self.current_agent = AGENTS["initial"]
         self.conversation_ended = False
+        self.transcript = Transcript()
+        self.states = {}
+        self.turns = OrderedDict()
+        self.dedupe_hits = 0
+        self.handoff_timings = []
+        self.last_error = None
 
 def main():
     # Initialize the multi-agent bot
     bot = MultiAgentDebtCollectionBot()
     
+    # Pay for connection setup before the first turn rather than during it
+    status = warm_up(configured_models())
+    if not status["ready"]:
+        print(f"Warm-up failed, continuing cold: {status['error']}")
+    
     print("Demo begins, type hi or hello to start")
     
     while True:
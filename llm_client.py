@@ -0,0 +1,274 @@
+import asyncio
+import os
+import threading
+import time
+import weakref
+
+import anthropic
+
+# httpx.Limits, taken from the SDK so we use whichever httpx it was built against
+_Limits = type(anthropic.DEFAULT_CONNECTION_LIMITS)
+
+
+class PoolConfig:
+    """Connection pool limits applied to every client the registry builds."""
+
+    def __init__(self, max_connections=100, max_keepalive_connections=20, keepalive_expiry=30.0):
+        self.max_connections = max_connections
+        self.max_keepalive_connections = max_keepalive_connections
+        self.keepalive_expiry = keepalive_expiry
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            max_connections=int(os.getenv("ANTHROPIC_POOL_MAX_CONNECTIONS", 100)),
+            max_keepalive_connections=int(os.getenv("ANTHROPIC_POOL_MAX_KEEPALIVE", 20)),
+            keepalive_expiry=float(os.getenv("ANTHROPIC_POOL_KEEPALIVE_EXPIRY", 30.0)),
+        )
+
+    def limits(self):
+        return _Limits(
+            max_connections=self.max_connections,
+            max_keepalive_connections=self.max_keepalive_connections,
+            keepalive_expiry=self.keepalive_expiry,
+        )
+
+
+class ClientRegistry:
+    """Process-wide cache of Anthropic clients, one keep-alive pool per API key.
+
+    Every agent of every conversation should get its client from here instead
+    of constructing its own, so handoffs and new sessions reuse warm connections.
+    """
+
+    def __init__(self, pool_config=None):
+        self.pool_config = pool_config or PoolConfig.from_env()
+        self._clients = {}
+        # Async clients are bound to the event loop their pool was opened on
+        self._async_clients = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+        self._stats = {
+            "client_lookups": 0,
+            "clients_created": 0,
+            "http_requests": 0,
+            "new_connections": 0,
+        }
+
+    def get_client(self, api_key=None):
+        api_key = api_key or os.getenv("ANTHROPIC_API_KEY")
+        with self._lock:
+            self._stats["client_lookups"] += 1
+            client = self._clients.get(api_key)
+            if client is None:
+                client = anthropic.Anthropic(api_key=api_key, http_client=self._http_client())
+                self._clients[api_key] = client
+                self._stats["clients_created"] += 1
+            return client
+
+    def get_async_client(self, api_key=None):
+        api_key = api_key or os.getenv("ANTHROPIC_API_KEY")
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            self._stats["client_lookups"] += 1
+            clients = self._async_clients.setdefault(loop, {})
+            client = clients.get(api_key)
+            if client is None:
+                # Retries are handled by transport.LLMTransport, not the SDK
+                client = anthropic.AsyncAnthropic(
+                    api_key=api_key, http_client=self._async_http_client(), max_retries=0
+                )
+                clients[api_key] = client
+                self._stats["clients_created"] += 1
+            return client
+
+    def _http_client(self):
+        return anthropic.DefaultHttpxClient(
+            limits=self.pool_config.limits(),
+            event_hooks={"request": [self._on_request]},
+        )
+
+    def _on_request(self, request):
+        self._count("http_requests")
+        # httpcore reports every new TCP connection through the trace extension;
+        # requests that don't trigger it went out on a pooled keep-alive connection
+        request.extensions["trace"] = self._trace
+
+    def _trace(self, event_name, info):
+        if event_name == "connection.connect_tcp.started":
+            self._count("new_connections")
+
+    def _async_http_client(self):
+        return anthropic.DefaultAsyncHttpxClient(
+            limits=self.pool_config.limits(),
+            event_hooks={"request": [self._aon_request]},
+        )
+
+    async def _aon_request(self, request):
+        self._count("http_requests")
+        request.extensions["trace"] = self._atrace
+
+    async def _atrace(self, event_name, info):
+        self._trace(event_name, info)
+
+    def _count(self, name, n=1):
+        with self._lock:
+            self._stats[name] += n
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats["reused_connections"] = stats["http_requests"] - stats["new_connections"]
+        stats["reused_clients"] = stats["client_lookups"] - stats["clients_created"]
+        return stats
+
+    async def awarm_up(self, connections=2, models=(), timeout=None):
+        """Open pooled connections ahead of the first debtor, and optionally prime each model.
+
+        The connections come from concurrent model-list calls, which cost no
+        tokens; a priming request is a one-token completion per model.
+        """
+        client = self.get_async_client()
+        before = self.stats()["new_connections"]
+        await asyncio.gather(*[client.models.list(limit=1, timeout=timeout) for _ in range(connections)])
+        await asyncio.gather(*[
+            client.messages.create(model=model, max_tokens=1, messages=[{"role": "user", "content": "Hi"}],
+                                   timeout=timeout)
+            for model in models
+        ])
+        return {"connections": self.stats()["new_connections"] - before, "primed_models": list(models)}
+
+    def close(self):
+        with self._lock:
+            clients, self._clients = list(self._clients.values()), {}
+        for client in clients:
+            client.close()
+
+    async def aclose(self):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            clients = list(self._async_clients.pop(loop, {}).values())
+        for client in clients:
+            await client.close()
+
+
+_registry = None
+_registry_lock = threading.Lock()
+_loop = None
+_readiness = {"ready": False, "error": None}
+_last_warm_up = None
+
+
+def get_registry():
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = ClientRegistry()
+        return _registry
+
+
+def get_client(api_key=None):
+    return get_registry().get_client(api_key)
+
+
+def get_async_client(api_key=None):
+    return get_registry().get_async_client(api_key)
+
+
+def warm_up(models=()):
+    """Warm the shared pool on the client loop, then mark the process ready.
+
+    models are primed only with LLM_WARMUP_PRIME=1. Failures are reported in
+    the result and leave the process not ready, so warm_up can be retried;
+    within LLM_WARMUP_RETRY seconds of a failed attempt it returns that
+    result instead of trying again, so callers on every page load never
+    queue up behind an unreachable API.
+    """
+    global _last_warm_up
+    with _registry_lock:
+        now = time.monotonic()
+        if not _readiness["ready"] and _last_warm_up is not None \
+                and now - _last_warm_up < float(os.getenv("LLM_WARMUP_RETRY", 30)):
+            return readiness()
+        _last_warm_up = now
+    return run_sync(awarm_up(models))
+
+
+async def awarm_up(models=(), registry=None):
+    """warm_up() for the pool of the running event loop, e.g. an ASGI server's."""
+    connections = int(os.getenv("LLM_WARMUP_CONNECTIONS", 2))
+    timeout = float(os.getenv("LLM_WARMUP_TIMEOUT", 5))
+    if os.getenv("LLM_WARMUP_PRIME", "0") != "1":
+        models = ()
+    start = time.perf_counter()
+    try:
+        # Bounded as a whole as well as per request, since SDK requests default
+        # to minutes: one timeout for the connections, one for the priming
+        total = timeout * (2 if models else 1)
+        report = await asyncio.wait_for((registry or get_registry()).awarm_up(connections, models, timeout), total)
+    except asyncio.TimeoutError:
+        _readiness.update(ready=False, error=f"warm-up timed out after {total:g}s", connections=0,
+                          primed_models=[])
+    except Exception as e:
+        _readiness.update(ready=False, error=str(e), connections=0, primed_models=[])
+    else:
+        _readiness.update(report, ready=True, error=None)
+        ready_file = os.getenv("LLM_READY_FILE")
+        if ready_file:
+            # For exec probes that can only check for a file
+            with open(ready_file, "w") as f:
+                f.write("ready\n")
+    _readiness["warm_up_seconds"] = time.perf_counter() - start
+    return readiness()
+
+
+def is_ready():
+    return _readiness["ready"]
+
+
+def readiness():
+    return dict(_readiness)
+
+
+def _client_loop():
+    global _loop
+    with _registry_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="llm-client-loop", daemon=True).start()
+        return _loop
+
+
+def run_sync(coro):
+    """Run a coroutine on the shared client loop and block until it finishes.
+
+    This is what the synchronous agent and bot APIs are built on: every sync
+    caller in the process drives the same loop, so they share one async pool.
+    """
+    if _in_event_loop():
+        coro.close()
+        raise RuntimeError("run_sync() cannot be called from a running event loop; await the coroutine instead")
+    return asyncio.run_coroutine_threadsafe(coro, _client_loop()).result()
+
+
+def iter_sync(agen):
+    """Drive an async generator on the shared client loop as a plain generator."""
+    if _in_event_loop():
+        raise RuntimeError("iter_sync() cannot be called from a running event loop; use async for instead")
+    loop = _client_loop()
+    try:
+        while True:
+            try:
+                yield asyncio.run_coroutine_threadsafe(agen.__anext__(), loop).result()
+            except StopAsyncIteration:
+                return
+    finally:
+        # Closing early (e.g. the consumer stopped reading) also closes the upstream stream
+        asyncio.run_coroutine_threadsafe(agen.aclose(), loop).result()
+
+
+def _in_event_loop():
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return False
+    return True
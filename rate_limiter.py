@@ -0,0 +1,166 @@
+import asyncio
+import os
+import threading
+import time
+from collections import deque
+
+# Highest first: debtor turns being answered now, then work that may be thrown
+# away (speculative replies, prefetches), then summaries and batch jobs
+LIVE = "live"
+PREFETCH = "prefetch"
+BACKGROUND = "background"
+PRIORITIES = (LIVE, PREFETCH, BACKGROUND)
+
+
+class _Waiter:
+    __slots__ = ("tokens", "loop", "wake")
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.loop = asyncio.get_running_loop()
+        self.wake = asyncio.Event()
+
+
+class RateLimiter:
+    """Process-wide requests-per-minute and tokens-per-minute budget for LLM calls.
+
+    Both are token buckets that refill continuously up to one minute's worth.
+    A call is charged its estimated tokens when it is let through and settled
+    against the usage the API reports once it is done, so the bucket tracks
+    what was really spent. Waiting calls are served strictly by priority,
+    first come first served within one priority. A limit of 0 is no limit.
+    """
+
+    def __init__(self, rpm=0, tpm=0):
+        self.rpm = rpm
+        self.tpm = tpm
+        self._requests = float(rpm)
+        self._tokens = float(tpm)
+        self._updated = time.monotonic()
+        self._queues = {priority: deque() for priority in PRIORITIES}
+        self._lock = threading.Lock()
+        self._stats = {priority: {"granted": 0, "wait_seconds": 0.0, "max_wait_seconds": 0.0}
+                       for priority in PRIORITIES}
+
+    @classmethod
+    def from_env(cls):
+        return cls(rpm=int(os.getenv("LLM_RPM", 0)), tpm=int(os.getenv("LLM_TPM", 0)))
+
+    async def acquire(self, tokens, priority=LIVE):
+        """Wait until one request of `tokens` estimated tokens fits; returns the tokens charged."""
+        if self.tpm:
+            # A request larger than the whole bucket would never fit otherwise
+            tokens = min(tokens, self.tpm)
+        start = time.monotonic()
+        waiter = _Waiter(tokens)
+        with self._lock:
+            self._queues[priority].append(waiter)
+        try:
+            while True:
+                waiter.wake.clear()
+                with self._lock:
+                    delay = self._grant(waiter)
+                if delay == 0:
+                    break
+                try:
+                    # Only the head of the line sleeps until the buckets refill;
+                    # everyone else is woken when it is their turn
+                    await asyncio.wait_for(waiter.wake.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+        except BaseException:
+            with self._lock:
+                if waiter in self._queues[priority]:
+                    self._queues[priority].remove(waiter)
+                    self._wake_head()
+            raise
+        waited = time.monotonic() - start
+        with self._lock:
+            stats = self._stats[priority]
+            stats["granted"] += 1
+            stats["wait_seconds"] += waited
+            stats["max_wait_seconds"] = max(stats["max_wait_seconds"], waited)
+        return tokens
+
+    def settle(self, charged, actual):
+        """Correct the token bucket once a call's real usage is known."""
+        if not self.tpm:
+            return
+        with self._lock:
+            self._refill()
+            # May go below zero when a call used more than estimated; later calls wait it off
+            self._tokens = min(float(self.tpm), self._tokens + charged - actual)
+            self._wake_head()
+
+    def _grant(self, waiter):
+        # 0 once the waiter is through, else how long it should sleep before looking again
+        head = self._head()
+        if head is not waiter:
+            return 1.0
+        self._refill()
+        needed = []
+        if self.rpm and self._requests < 1:
+            needed.append((1 - self._requests) * 60 / self.rpm)
+        if self.tpm and self._tokens < waiter.tokens:
+            needed.append((waiter.tokens - self._tokens) * 60 / self.tpm)
+        if needed:
+            return max(needed)
+        if self.rpm:
+            self._requests -= 1
+        if self.tpm:
+            self._tokens -= waiter.tokens
+        for queue in self._queues.values():
+            if queue and queue[0] is waiter:
+                queue.popleft()
+                break
+        self._wake_head()
+        return 0
+
+    def _head(self):
+        for priority in PRIORITIES:
+            if self._queues[priority]:
+                return self._queues[priority][0]
+        return None
+
+    def _wake_head(self):
+        head = self._head()
+        if head is not None:
+            head.loop.call_soon_threadsafe(head.wake.set)
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self._updated
+        self._updated = now
+        if self.rpm:
+            self._requests = min(float(self.rpm), self._requests + elapsed * self.rpm / 60)
+        if self.tpm:
+            self._tokens = min(float(self.tpm), self._tokens + elapsed * self.tpm / 60)
+
+    def stats(self):
+        """Calls let through, queue wait and calls waiting now, per priority."""
+        with self._lock:
+            self._refill()
+            report = {
+                priority: {
+                    "granted": stats["granted"],
+                    "waiting": len(self._queues[priority]),
+                    "mean_wait_seconds": stats["wait_seconds"] / stats["granted"] if stats["granted"] else 0.0,
+                    "max_wait_seconds": stats["max_wait_seconds"],
+                }
+                for priority, stats in self._stats.items()
+            }
+            report["available_requests"] = self._requests if self.rpm else None
+            report["available_tokens"] = self._tokens if self.tpm else None
+        return report
+
+
+_limiter = None
+_limiter_lock = threading.Lock()
+
+
+def get_rate_limiter():
+    global _limiter
+    with _limiter_lock:
+        if _limiter is None:
+            _limiter = RateLimiter.from_env()
+        return _limiter
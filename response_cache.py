@@ -0,0 +1,212 @@
+import hashlib
+import json
+import math
+import os
+import re
+import threading
+import time
+import zlib
+from array import array
+from collections import OrderedDict
+
+_WHITESPACE = re.compile(r"\s+")
+_NOT_WORD = re.compile(r"[^a-z0-9 ]+")
+# Character n-grams barely change when a statement is negated, so such
+# utterances are never matched by similarity
+_NEGATION = re.compile(r"\b(?:not|no|never|nope|nah|none|nothing|nobody|neither|nor|cannot|wrong|dont|doesnt|didnt|isnt|arent|wasnt|cant|wont)\b|n't\b")
+
+
+def normalize_text(text):
+    return _WHITESPACE.sub(" ", text).strip()
+
+
+def normalize_utterance(text):
+    # Debtor turns also ignore case and surrounding punctuation: "Yes speaking!" == "yes speaking"
+    return normalize_text(text).lower().strip(" .,!?'\"")
+
+
+def has_negation(text):
+    return _NEGATION.search(normalize_utterance(text).replace("\u2019", "'")) is not None
+
+
+def request_key(agent_name, request):
+    """Stable key for an agent request: model, normalized system prompt and history."""
+    system = request["system"]
+    if not isinstance(system, str):
+        system = "\n".join(block["text"] for block in system)
+    messages = [
+        (m["role"], normalize_utterance(m["content"]) if m["role"] == "user" else normalize_text(m["content"]))
+        for m in request["messages"]
+    ]
+    payload = json.dumps([agent_name, request["model"], normalize_text(system), messages])
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class ResponseCache:
+    """Bounded LRU cache of agent replies whose entries expire after ttl seconds."""
+
+    def __init__(self, max_entries=1024, ttl=600.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0}
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            max_entries=int(os.getenv("RESPONSE_CACHE_SIZE", 1024)),
+            ttl=float(os.getenv("RESPONSE_CACHE_TTL", 600)),
+        )
+
+    def get(self, key):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] <= now:
+                del self._entries[key]
+                self._stats["expirations"] += 1
+                entry = None
+            if entry is None:
+                self._stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats["hits"] += 1
+            return entry[1]
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._stats["evictions"] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats, size=len(self._entries))
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_ratio"] = stats["hits"] / lookups if lookups else 0.0
+        return stats
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+def ngram_vector(text, dims=256, n=3):
+    """Sparse unit vector of hashed character n-grams, as {dimension: weight}."""
+    text = " " + _WHITESPACE.sub(" ", _NOT_WORD.sub("", normalize_utterance(text))) + " "
+    counts = {}
+    for i in range(max(len(text) - n + 1, 1)):
+        # crc32 rather than hash() so vectors are stable across processes
+        dim = zlib.crc32(text[i:i + n].encode()) % dims
+        counts[dim] = counts.get(dim, 0) + 1
+    norm = math.sqrt(sum(c * c for c in counts.values()))
+    return {dim: c / norm for dim, c in counts.items()}
+
+
+class _Bucket:
+    # Fixed-size ring of vectors packed into one float array
+    __slots__ = ("vectors", "replies", "next")
+
+    def __init__(self, dims, capacity):
+        self.vectors = array("f", bytes(4 * dims * capacity))
+        self.replies = []
+        self.next = 0
+
+
+class SimilarityCache:
+    """Near-duplicate reply cache: one small vector index per agent conversation state.
+
+    Debtor utterances are embedded offline with ngram_vector, and a lookup
+    returns the reply cached for the most similar earlier utterance in the
+    same state when its cosine similarity reaches the caller's threshold.
+    Utterances with a negation are neither looked up nor stored, since
+    "this is not john doe" scores close to "this is john doe".
+    """
+
+    def __init__(self, dims=256, bucket_size=64, max_buckets=4096):
+        self.dims = dims
+        self.bucket_size = bucket_size
+        self.max_buckets = max_buckets
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "negations": 0, "lookup_seconds": 0.0}
+
+    def lookup(self, state_key, utterance, threshold):
+        if has_negation(utterance):
+            with self._lock:
+                self._stats["negations"] += 1
+            return None
+        start = time.perf_counter()
+        query = ngram_vector(utterance, self.dims)
+        best, best_score = None, threshold
+        with self._lock:
+            bucket = self._buckets.get(state_key)
+            if bucket is not None:
+                self._buckets.move_to_end(state_key)
+                vectors = bucket.vectors
+                for i, reply in enumerate(bucket.replies):
+                    base = i * self.dims
+                    score = sum(vectors[base + dim] * weight for dim, weight in query.items())
+                    if score >= best_score:
+                        best, best_score = reply, score
+            self._stats["hits" if best is not None else "misses"] += 1
+            self._stats["lookup_seconds"] += time.perf_counter() - start
+        return best
+
+    def put(self, state_key, utterance, reply):
+        if has_negation(utterance):
+            return
+        vector = ngram_vector(utterance, self.dims)
+        with self._lock:
+            bucket = self._buckets.get(state_key)
+            if bucket is None:
+                bucket = self._buckets[state_key] = _Bucket(self.dims, self.bucket_size)
+                if len(self._buckets) > self.max_buckets:
+                    self._buckets.popitem(last=False)
+            self._buckets.move_to_end(state_key)
+            slot = bucket.next
+            base = slot * self.dims
+            bucket.vectors[base:base + self.dims] = array("f", bytes(4 * self.dims))
+            for dim, weight in vector.items():
+                bucket.vectors[base + dim] = weight
+            if slot < len(bucket.replies):
+                bucket.replies[slot] = reply
+            else:
+                bucket.replies.append(reply)
+            bucket.next = (slot + 1) % self.bucket_size
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats, states=len(self._buckets))
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_ratio"] = stats["hits"] / lookups if lookups else 0.0
+        stats["mean_lookup_us"] = 1e6 * stats.pop("lookup_seconds") / lookups if lookups else 0.0
+        return stats
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+_cache = None
+_similarity_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_response_cache():
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = ResponseCache.from_env()
+        return _cache
+
+
+def get_similarity_cache():
+    global _similarity_cache
+    with _cache_lock:
+        if _similarity_cache is None:
+            _similarity_cache = SimilarityCache()
+        return _similarity_cache
@@ -0,0 +1,104 @@
+from datetime import datetime
+
+# Fill-ins for the call scripts; override per debtor when creating the bot
+DEFAULT_DEBTOR = {
+    "agent_name": "Alex",
+    "bank": "Credence Bank",
+    "debtor_name": "John Doe",
+    "salutation": "Sir",
+    "product": "<Product>",
+    "former_bank": "Dbank",
+    "hotline": "1-800-XXX-XXXX",
+    "balance": "<amount>",
+    "discount": "<X%>",
+    "settlement_amount": "<amount>",
+    "plan_total": "<amount>",
+    "initial_payment": "<amount>",
+    "monthly_installment": "<Amount>",
+    "months": "<months>",
+}
+
+# Lines the agents' prompts tell the model to say verbatim
+SCRIPTS = {
+    "greeting": (
+        "Good {time_of_day} {salutation}. My name is {agent_name} calling from {bank} "
+        "and I would like to speak with {debtor_name}."
+    ),
+    "verification_request": (
+        "To ensure I am speaking with the correct person, may I confirm your last 4 digits "
+        "of your IC number or Date of Birth please?"
+    ),
+    "discussion_intro": (
+        "Thank you for the verification this call may be recorded for quality and compliances purposes. "
+        "The reason for this call is to inform you that your {product} account formerly from {former_bank} "
+        "is still outstanding and we would like to assist you in working out a payment plan options that "
+        "might work for you. Would you be open to discussing a plan that fits you."
+    ),
+    "balance": (
+        "Thank you for your cooperation and your current outstanding balance is RM{balance} and it could sound "
+        "huge to you as the debt was outstanding for some time without any payment. However, we would like to "
+        "assist you to settle the debt with 2 payment plans options that might work for you."
+    ),
+    "payment_plans": (
+        "The payment plan 1 is a one-time payment option with substantial discount of {discount} where you could "
+        "settle the debt in full for {settlement_amount}. This is the fastest way to clear your record and get "
+        "removed from blacklist as once you have paid the debt we will issue a release letter and you'll be "
+        "removed from the blacklist. This can help improve your financial standing and move forward without "
+        "restrictions. The payment plan 2 is a monthly payment plan for RM{plan_total} starting with an initial "
+        "payment of RM{initial_payment}, followed by monthly installment of RM{monthly_installment} over "
+        "{months}. We will remove your blacklist record only once the account is fully settled."
+    ),
+    "sorry": (
+        "I apologize, but I haven't been programmed to handle this situation yet. "
+        "Please contact our customer service at {hotline} during business hours. Have a good day!"
+    ),
+    "closure": (
+        "Thank you for your cooperation and I will be connecting this call to the Credit Management officer "
+        "that in charge of your account for further discussion. Please hold the line and at the same time you "
+        "will receive a SMS notification with the detail of the Person In charge and contact detail to call "
+        "back if this line is disconnected during the transfer of this call."
+    ),
+    "appointment_request": (
+        "We have noted your request for a call back and would like to confirm your preferred date and time "
+        "for the discussion."
+    ),
+    "appointment_confirmed": (
+        "Thank you for your response and we will schedule a call to you as per your schedule and our Credit "
+        "Management Officer in charge of your account will call you back on the given date and time and at the "
+        "same time you will receive a SMS notification with the detail of the Person In charge and contact detail "
+        "for your reference. Thank you and have nice day."
+    ),
+    # Said instead of an error message when the model cannot be reached
+    "technical_retry": "I'm sorry, I didn't quite catch that. Could you please repeat it?",
+    "technical_outage": (
+        "I'm sorry, we are experiencing technical difficulties at the moment. "
+        "Please contact our customer service at {hotline} or we will call you back shortly."
+    ),
+    # Said when admission control sheds the turn under load
+    "busy": (
+        "I'm sorry, all our lines are busy at the moment. Please try again in a few minutes or contact our "
+        "customer service at {hotline}."
+    ),
+}
+
+
+def time_of_day(now=None):
+    hour = (now or datetime.now()).hour
+    if hour < 12:
+        return "morning"
+    if hour < 18:
+        return "afternoon"
+    return "evening"
+
+
+class ScriptRenderer:
+    """Renders script lines locally from debtor details and the time of day."""
+
+    __slots__ = ("variables",)
+
+    def __init__(self, debtor=None):
+        # Conversations without their own details share the defaults
+        self.variables = dict(DEFAULT_DEBTOR, **debtor) if debtor else DEFAULT_DEBTOR
+
+    def render(self, name, now=None):
+        return SCRIPTS[name].format(time_of_day=time_of_day(now), **self.variables)
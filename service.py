@@ -0,0 +1,302 @@
+"""Headless conversation service for dialers and voice gateways: a plain
+ASGI app over HTTP and WebSocket, served with e.g. `uvicorn service:app`.
+Endpoints are listed in the README."""
+import asyncio
+import json
+import os
+import re
+import time
+import uuid
+from urllib.parse import parse_qs
+
+from actor import ConversationActor
+from admission import get_admission_controller
+from horse import MultiAgentDebtCollectionBot, configured_models
+from llm_client import awarm_up, readiness
+from rate_limiter import get_rate_limiter
+
+_ROUTES = [
+    ("POST", re.compile(r"^/conversations/?$"), "create"),
+    ("GET", re.compile(r"^/conversations/(?P<id>[0-9a-f]{32})$"), "show"),
+    ("POST", re.compile(r"^/conversations/(?P<id>[0-9a-f]{32})/messages$"), "message"),
+    ("DELETE", re.compile(r"^/conversations/(?P<id>[0-9a-f]{32})$"), "close"),
+    ("GET", re.compile(r"^/health$"), "health"),
+    ("GET", re.compile(r"^/ready$"), "ready"),
+]
+_WEBSOCKET = re.compile(r"^/conversations/(?P<id>[0-9a-f]{32})/ws$")
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class Conversation:
+    # Every turn goes through the actor, so concurrent requests for one
+    # conversation never interleave inside the bot
+    __slots__ = ("id", "bot", "actor", "last_active")
+
+    def __init__(self, bot):
+        self.id = uuid.uuid4().hex
+        self.bot = bot
+        self.actor = ConversationActor(bot)
+        self.last_active = time.monotonic()
+
+    def summary(self):
+        return {
+            "id": self.id,
+            "agent": self.bot.current_agent.name,
+            "ended": self.bot.conversation_ended,
+        }
+
+    def to_json(self):
+        return dict(self.summary(), transcript=self.bot.transcript.entries(), stats=self.bot.call_stats())
+
+
+class ConversationService:
+    """ASGI app holding the live conversations of one worker.
+
+    Conversations idle for longer than idle_timeout seconds are dropped by a
+    sweep every sweep_interval seconds while the app runs, and new ones are refused with 503 and Retry-After while the admission
+    controller reports the LLM API overloaded. A warm-up that fails at
+    startup is retried in the background, from warm_up_retry seconds apart
+    doubling up to a minute, until it succeeds.
+    """
+
+    def __init__(self, transport=None, idle_timeout=1800.0, speculative=False, warm_up_retry=1.0,
+                 sweep_interval=60.0):
+        self.transport = transport
+        self.warm_up_retry = warm_up_retry
+        self.sweep_interval = sweep_interval
+        self._warming = None
+        self._sweeping = None
+        self.admission = transport.admission if transport else get_admission_controller()
+        self.idle_timeout = idle_timeout
+        self.speculative = speculative
+        self.conversations = {}
+
+    @classmethod
+    def from_env(cls, transport=None):
+        return cls(
+            transport,
+            idle_timeout=float(os.getenv("CONVERSATION_IDLE_TIMEOUT", 1800)),
+            speculative=os.getenv("SPECULATIVE_REPLIES", "0") == "1",
+        )
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+        elif scope["type"] == "websocket":
+            await self._websocket(scope, receive, send)
+        else:
+            await self._http(scope, receive, send)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                # Warm this loop's pool; /ready stays 503 until it succeeds
+                if not (await self._warm_up())["ready"]:
+                    self._warming = asyncio.ensure_future(self._keep_warming())
+                self._sweeping = asyncio.ensure_future(self._keep_sweeping())
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                for task in (self._warming, self._sweeping):
+                    if task is not None:
+                        task.cancel()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    def _warm_up(self):
+        return awarm_up(configured_models(), self.transport.registry if self.transport else None)
+
+    async def _keep_warming(self):
+        delay = self.warm_up_retry
+        while True:
+            await asyncio.sleep(delay)
+            if (await self._warm_up())["ready"]:
+                return
+            delay = min(delay * 2, 60.0)
+
+    async def _http(self, scope, receive, send):
+        try:
+            handler, params = self._route(scope["method"], scope["path"])
+            body = await _read_body(receive)
+            await handler(params, body, parse_qs(scope.get("query_string", b"").decode()), send)
+        except HTTPError as e:
+            await _send_json(send, e.status, {"error": str(e)})
+
+    def _route(self, method, path):
+        allowed = False
+        for route_method, pattern, name in _ROUTES:
+            match = pattern.match(path)
+            if match:
+                allowed = True
+                if route_method == method:
+                    return getattr(self, "_" + name), match.groupdict()
+        raise HTTPError(405 if allowed else 404, "method not allowed" if allowed else "not found")
+
+    def _get(self, conversation_id):
+        conversation = self.conversations.get(conversation_id)
+        if conversation is None:
+            raise HTTPError(404, "no such conversation")
+        conversation.last_active = time.monotonic()
+        return conversation
+
+    async def _keep_sweeping(self):
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            self._sweep()
+
+    def _sweep(self):
+        now = time.monotonic()
+        for conversation_id, conversation in list(self.conversations.items()):
+            if now - conversation.last_active > self.idle_timeout:
+                conversation.actor.close()
+                del self.conversations[conversation_id]
+
+    async def _create(self, params, body, query, send):
+        debtor = _debtor(_json_body(body))
+        admission = await self.admission.aadmit()
+        if not admission["admitted"]:
+            await _send_json(send, 503, {"error": "busy, retry later", "reason": admission["reason"],
+                                         "retry_after": admission["retry_after"]},
+                             [(b"retry-after", str(admission["retry_after"]).encode())])
+            return
+        bot = MultiAgentDebtCollectionBot(self.transport, debtor, self.speculative)
+        conversation = Conversation(bot)
+        self.conversations[conversation.id] = conversation
+        await _send_json(send, 201, conversation.summary())
+
+    async def _show(self, params, body, query, send):
+        await _send_json(send, 200, self._get(params["id"]).to_json())
+
+    async def _message(self, params, body, query, send):
+        conversation = self._get(params["id"])
+        data = _json_body(body)
+        turn = conversation.actor.submit(_text(data), _turn_id(data))
+        if query.get("stream", ["0"])[0] not in ("1", "true"):
+            reply = await turn.reply()
+            await _send_json(send, 200, dict(conversation.summary(), reply=reply, cancelled=turn.cancelled))
+            return
+        await send({"type": "http.response.start", "status": 200,
+                    "headers": [(b"content-type", b"application/x-ndjson")]})
+        async for delta in turn:
+            await send({"type": "http.response.body", "body": _ndjson({"delta": delta}), "more_body": True})
+        done = dict(conversation.summary(), done=True, cancelled=turn.cancelled)
+        await send({"type": "http.response.body", "body": _ndjson(done)})
+
+    async def _close(self, params, body, query, send):
+        conversation = self._get(params["id"])
+        conversation.actor.close()
+        del self.conversations[conversation.id]
+        await _send_json(send, 200, conversation.to_json())
+
+    async def _health(self, params, body, query, send):
+        await _send_json(send, 200, {"status": "ok", "conversations": len(self.conversations),
+                                     "rate_limiter": self._rate_limiter().stats(),
+                                     "admission": self.admission.stats()})
+
+    def _rate_limiter(self):
+        return self.transport.rate_limiter if self.transport else get_rate_limiter()
+
+    async def _ready(self, params, body, query, send):
+        status = readiness()
+        await _send_json(send, 200 if status["ready"] else 503, status)
+
+    async def _websocket(self, scope, receive, send):
+        match = _WEBSOCKET.match(scope["path"])
+        conversation = self.conversations.get(match.group("id")) if match else None
+        message = await receive()
+        if message["type"] != "websocket.connect":
+            return
+        if conversation is None:
+            await send({"type": "websocket.close", "code": 4404})
+            return
+        await send({"type": "websocket.accept"})
+        # Keep reading while a turn streams, so a new message can supersede it
+        forwarding = set()
+        while True:
+            message = await receive()
+            if message["type"] == "websocket.disconnect":
+                for task in forwarding:
+                    task.cancel()
+                return
+            try:
+                data = json.loads(message.get("text") or message.get("bytes") or b"{}")
+                text, turn_id = _text(data), _turn_id(data)
+            except (HTTPError, ValueError, AttributeError) as e:
+                await _send_event(send, {"type": "error", "error": str(e)})
+                continue
+            conversation.last_active = time.monotonic()
+            task = asyncio.ensure_future(self._forward(conversation, conversation.actor.submit(text, turn_id), send))
+            forwarding.add(task)
+            task.add_done_callback(forwarding.discard)
+
+    async def _forward(self, conversation, turn, send):
+        async for delta in turn:
+            await _send_event(send, {"type": "delta", "text": delta})
+        await _send_event(send, dict(conversation.summary(), type="done", cancelled=turn.cancelled))
+
+
+async def _read_body(receive):
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            return body
+
+
+def _json_body(body):
+    if not body:
+        return {}
+    try:
+        data = json.loads(body)
+    except ValueError:
+        raise HTTPError(400, "body is not valid JSON")
+    if not isinstance(data, dict):
+        raise HTTPError(400, "body must be a JSON object")
+    return data
+
+
+def _text(data):
+    text = data.get("text")
+    if not isinstance(text, str) or not text.strip():
+        raise HTTPError(400, 'expected {"text": "..."}')
+    return text.strip()
+
+
+def _debtor(data):
+    # Overrides for the script variables, e.g. {"debtor_name": "Jane Roe", "balance": "1000"}
+    debtor = data.get("debtor")
+    if debtor is not None and (not isinstance(debtor, dict)
+                               or not all(isinstance(value, str) for value in debtor.values())):
+        raise HTTPError(400, "debtor must be an object of string values")
+    return debtor
+
+
+def _turn_id(data):
+    # Optional client key for the turn; resending it replays the stored reply
+    turn_id = data.get("turn_id")
+    if turn_id is not None and (not isinstance(turn_id, str) or not turn_id):
+        raise HTTPError(400, "turn_id must be a non-empty string")
+    return turn_id
+
+
+def _ndjson(data):
+    return json.dumps(data).encode() + b"\n"
+
+
+async def _send_json(send, status, data, headers=()):
+    await send({"type": "http.response.start", "status": status,
+                "headers": [(b"content-type", b"application/json")] + list(headers)})
+    await send({"type": "http.response.body", "body": json.dumps(data).encode()})
+
+
+async def _send_event(send, data):
+    await send({"type": "websocket.send", "text": json.dumps(data)})
+
+
+app = ConversationService.from_env()
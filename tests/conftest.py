@@ -0,0 +1,32 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from admission import AdmissionController
+from fake_llm import FakeRegistry
+from rate_limiter import RateLimiter
+from response_cache import get_response_cache, get_similarity_cache
+from transport import LLMTransport
+
+
+@pytest.fixture(autouse=True)
+def empty_caches():
+    # The reply caches are process-wide; every test starts from empty ones
+    get_response_cache().clear()
+    get_similarity_cache().clear()
+    yield
+    get_response_cache().clear()
+    get_similarity_cache().clear()
+
+
+@pytest.fixture
+def registry():
+    return FakeRegistry()
+
+
+@pytest.fixture
+def transport(registry):
+    return LLMTransport(registry, base_delay=0.001, rate_limiter=RateLimiter(), admission=AdmissionController())
@@ -0,0 +1,80 @@
+import asyncio
+
+import anthropic
+import pytest
+
+from admission import AdmissionController
+from test_transport import api_error, make_transport, read
+from transport import LLMOverloaded, LLMRequestError
+
+
+def test_too_many_calls_in_flight_sheds_unverified_turns():
+    controller = AdmissionController(max_in_flight=2, retry_after=7)
+    controller.call_started()
+    assert controller.admit()["admitted"]
+    controller.call_started()
+    decision = controller.admit()
+    assert not decision["admitted"] and "2 LLM calls in flight" in decision["reason"]
+    assert decision["retry_after"] == 7
+    assert controller.admit(protected=True)["admitted"]
+    controller.call_finished(0.1)
+    assert controller.admit()["admitted"]
+    stats = controller.stats()
+    assert (stats["admitted"], stats["shed"], stats["protected"], stats["in_flight"]) == (2, 1, 1, 1)
+
+
+def test_slow_first_tokens_overload_once_there_are_enough_samples():
+    controller = AdmissionController(max_latency=1.0, min_samples=5)
+    for _ in range(4):
+        controller.call_started()
+        controller.call_finished(3.0)
+    assert controller.overload() is None
+    controller.call_started()
+    controller.call_finished(3.0)
+    assert "latency p90 is 3.0s" in controller.overload()
+
+
+def test_failing_calls_overload():
+    controller = AdmissionController(max_error_rate=0.5, min_samples=4)
+    for failed in (True, True, True, False):
+        controller.call_started()
+        controller.call_finished(None, failed)
+    assert controller.overload() == "75% of recent LLM calls failed"
+    # Calls without a first chunk leave the latency window alone
+    assert not controller._latencies
+
+
+def test_deferred_turn_is_admitted_once_the_load_clears():
+    controller = AdmissionController(max_in_flight=1, defer_seconds=1.0)
+
+    async def main():
+        controller.call_started()
+        asyncio.get_running_loop().call_later(0.1, controller.call_finished, 0.1)
+        assert (await controller.aadmit())["admitted"]
+        assert controller.stats()["deferred"] == 1
+
+        controller.call_started()
+        controller.defer_seconds = 0.1
+        assert not (await controller.aadmit())["admitted"]
+        # Protected turns never wait
+        assert (await asyncio.wait_for(controller.aadmit(protected=True), 0.05))["admitted"]
+
+    asyncio.run(main())
+
+
+def test_transport_reports_each_call(registry):
+    transport = make_transport(registry, max_retries=0)
+    registry.failures += [ValueError("bad request"), api_error(anthropic.RateLimitError, 429, "rate_limit_error")]
+
+    async def main():
+        with pytest.raises(LLMRequestError):
+            await read(transport)
+        with pytest.raises(LLMOverloaded):
+            await read(transport)
+        assert await read(transport)
+        assert transport.admission.in_flight == 0
+        # A rejected request says nothing about the load; an overload does
+        assert list(transport.admission._outcomes) == [False, True, False]
+        assert len(transport.admission._latencies) == 1
+
+    asyncio.run(main())
@@ -0,0 +1,158 @@
+import asyncio
+
+import pytest
+
+from horse import DiscussionAgent, MultiAgentDebtCollectionBot
+
+
+def label(request, labels):
+    # Rules for the fake's decide tool, by the debtor's latest message
+    text = request["messages"][-1]["content"].lower()
+    if "confirmed" in labels:
+        return "confirmed" if "speaking" in text else "not_confirmed"
+    if "verified" in labels:
+        return "verified" if any(c.isdigit() for c in text) else "failed"
+    if "balance" in labels:
+        for name in ("balance", "plans", "interested", "callback"):
+            if name in text:
+                return name
+    return "other"
+
+
+async def verified(bot):
+    for text in ("hello", "yes speaking", "1234"):
+        await bot.aget_response(text)
+    assert bot.current_agent.name == "discussion"
+
+
+def test_cached_outcomes_are_rendered_for_each_debtor(registry, transport):
+    registry.label = label
+
+    async def main():
+        replies = []
+        for balance in ("1000", "99999"):
+            bot = MultiAgentDebtCollectionBot(transport, {"balance": balance})
+            await verified(bot)
+            replies.append((bot, await bot.aget_response("what is my balance")))
+        (first, first_reply), (second, second_reply) = replies
+        assert "RM1000 " in first_reply
+        assert "RM99999 " in second_reply
+        assert second.call_stats()["cached_replies"] > 0
+
+    asyncio.run(main())
+
+
+def negation_aware_label(request, labels):
+    text = request["messages"][-1]["content"].lower()
+    negated = " not " in f" {text} "
+    if "confirmed" in labels:
+        return "not_confirmed" if negated else "confirmed"
+    if "verified" in labels:
+        return "verified"
+    return "other" if negated else "interested"
+
+
+def test_negated_utterances_are_not_routed_by_similarity(registry, transport):
+    registry.label = negation_aware_label
+
+    async def main():
+        confirmed = MultiAgentDebtCollectionBot(transport)
+        await confirmed.aget_response("hello")
+        await confirmed.aget_response("this is john doe")
+        assert confirmed.current_agent.name == "verification"
+        await confirmed.aget_response("1234")
+        await confirmed.aget_response("I'm interested in plan 1")
+        assert confirmed.current_agent.name == "closure"
+
+        denied = MultiAgentDebtCollectionBot(transport)
+        await denied.aget_response("hello")
+        await denied.aget_response("this is not john doe")
+        assert denied.current_agent.name == "sorry"
+
+        undecided = MultiAgentDebtCollectionBot(transport)
+        for text in ("hello", "this is john doe", "1234"):
+            await undecided.aget_response(text)
+        await undecided.aget_response("I'm not interested in plan 1")
+        assert undecided.current_agent.name == "discussion"
+        assert undecided.call_stats()["similar_replies"] == 0
+
+    asyncio.run(main())
+
+
+def test_similar_free_form_replies_are_reused(registry, transport):
+    registry.label = label
+
+    async def main():
+        first = MultiAgentDebtCollectionBot(transport)
+        await verified(first)
+        await first.aget_response("what is this call about")
+        second = MultiAgentDebtCollectionBot(transport)
+        await verified(second)
+        reply = await second.aget_response("so what is this call about")
+        assert reply == "You said: what is this call about"
+        assert second.call_stats()["similar_replies"] == 1
+
+    asyncio.run(main())
+
+
+def test_repeated_turn_id_replays_reply_but_not_fallback(registry, transport):
+    registry.label = label
+
+    async def main():
+        bot = MultiAgentDebtCollectionBot(transport)
+        greeting = await bot.aget_response("hello", "turn-1")
+        assert await bot.aget_response("hello", "turn-1") == greeting
+        assert bot.dedupe_hits == 1
+
+        # A failed call answers with the fallback line; retrying the turn calls the model
+        registry.failures.append(ValueError("bad request"))
+        fallback = await bot.aget_response("yes speaking", "turn-2")
+        assert "didn't quite catch that" in fallback and bot.current_agent.name == "initial"
+        reply = await bot.aget_response("yes speaking", "turn-2")
+        assert "last 4 digits" in reply and bot.current_agent.name == "verification"
+        assert bot.dedupe_hits == 1
+
+    asyncio.run(main())
+
+
+def test_speculation_failure_reaches_the_reply(registry, transport, monkeypatch):
+    registry.label = label
+
+    async def broken(self, state, request, priority=None):
+        raise RuntimeError("speculation failed")
+        yield
+
+    async def main():
+        bot = MultiAgentDebtCollectionBot(transport, speculative=True)
+        await verified(bot)
+        monkeypatch.setattr(DiscussionAgent, "_generate", broken)
+        with pytest.raises(RuntimeError):
+            await asyncio.wait_for(bot.aget_response("what is this call about"), 5)
+        assert bot.call_stats()["speculations_used"] == 1
+
+    asyncio.run(main())
+
+
+def test_truncated_reply_is_continued(registry, transport):
+    registry.label = label
+    words = " ".join(f"word{i}" for i in range(150))
+
+    def reply(request):
+        # Carries on after a prefilled partial reply, like the model does
+        last = request["messages"][-1]
+        return words[len(last["content"]):] if last["role"] == "assistant" else words
+
+    async def main():
+        bot = MultiAgentDebtCollectionBot(transport)
+        await verified(bot)
+        registry.reply = reply
+        sent = len(registry.requests)
+        assert (await bot.aget_response("what is this call about")).split() == words.split()
+        continued = registry.requests[-1]
+        assert len(registry.requests) - sent == 3
+        assert continued["messages"][-1]["role"] == "assistant"
+        assert not continued["messages"][-1]["content"].endswith(" ")
+        stats = bot.call_stats()
+        assert stats["truncated_replies"] == 1 and stats["continuations"] == 1
+
+    asyncio.run(main())
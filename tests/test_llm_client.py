@@ -0,0 +1,45 @@
+import asyncio
+import time
+
+import llm_client
+from fake_llm import FakeRegistry
+
+
+def test_warm_up_is_bounded_and_not_retried_at_once(monkeypatch):
+    monkeypatch.setenv("LLM_WARMUP_TIMEOUT", "0.05")
+    monkeypatch.setattr(llm_client, "_registry", FakeRegistry(delay=5))
+    monkeypatch.setattr(llm_client, "_readiness", {"ready": False, "error": None})
+    monkeypatch.setattr(llm_client, "_last_warm_up", None)
+
+    start = time.monotonic()
+    status = llm_client.warm_up()
+    assert not status["ready"] and "timed out" in status["error"]
+    assert time.monotonic() - start < 1
+
+    # Within LLM_WARMUP_RETRY of the failure the last result is returned as is
+    start = time.monotonic()
+    assert llm_client.warm_up()["error"] == status["error"]
+    assert time.monotonic() - start < 0.01
+
+    monkeypatch.setenv("LLM_WARMUP_RETRY", "0")
+    llm_client._registry.delay = 0
+    assert llm_client.warm_up()["ready"]
+
+
+def test_awarm_up_warms_the_given_registry(monkeypatch):
+    monkeypatch.setattr(llm_client, "_readiness", {"ready": False, "error": None})
+    status = asyncio.run(llm_client.awarm_up(["model"], FakeRegistry()))
+    assert status["ready"] and status["connections"] == 2
+
+
+def test_primed_models_share_the_warm_up_bound(monkeypatch):
+    monkeypatch.setenv("LLM_WARMUP_TIMEOUT", "0.3")
+    monkeypatch.setenv("LLM_WARMUP_PRIME", "1")
+    monkeypatch.setattr(llm_client, "_readiness", {"ready": False, "error": None})
+    registry = llm_client.ClientRegistry()
+    fake = FakeRegistry(delay=0.1)
+    monkeypatch.setattr(registry, "get_async_client", fake.get_async_client)
+
+    status = asyncio.run(llm_client.awarm_up(["a", "b", "c"], registry))
+    assert status["ready"] and status["primed_models"] == ["a", "b", "c"]
+    assert len(fake.requests) == 3
@@ -0,0 +1,100 @@
+import asyncio
+import time
+
+import pytest
+
+from rate_limiter import BACKGROUND, LIVE, PREFETCH, RateLimiter
+from transport import LLMRequestError, LLMTimeout
+from test_transport import REQUEST, make_transport, read
+
+
+def test_waiters_are_served_by_priority():
+    # 100 tokens a second, drained: each waiter below needs a tenth of a second
+    limiter = RateLimiter(tpm=6000)
+
+    async def main():
+        await limiter.acquire(6000)
+        granted = []
+
+        async def wait(priority):
+            await limiter.acquire(10, priority)
+            granted.append(priority)
+
+        tasks = []
+        for priority in (BACKGROUND, PREFETCH, LIVE):
+            tasks.append(asyncio.ensure_future(wait(priority)))
+            await asyncio.sleep(0)
+        await asyncio.wait_for(asyncio.gather(*tasks), 2)
+        assert granted == [LIVE, PREFETCH, BACKGROUND]
+        assert limiter.stats()[LIVE]["granted"] == 2
+
+    asyncio.run(main())
+
+
+def test_waiter_behind_a_vanished_head_polls_again():
+    limiter = RateLimiter(tpm=6000)
+
+    async def main():
+        await limiter.acquire(6000)
+        head = asyncio.ensure_future(limiter.acquire(10))
+        await asyncio.sleep(0)
+        start = time.monotonic()
+        behind = asyncio.ensure_future(limiter.acquire(10))
+        await asyncio.sleep(0)
+        # The head leaves the line without waking anyone, e.g. its loop died
+        with limiter._lock:
+            limiter._queues[LIVE].popleft()
+        await asyncio.wait_for(behind, 2)
+        assert 0.9 < time.monotonic() - start < 1.5
+        head.cancel()
+        await asyncio.gather(head, return_exceptions=True)
+
+    asyncio.run(main())
+
+
+def test_settle_refunds_unused_tokens_and_carries_a_deficit():
+    limiter = RateLimiter(tpm=6000)
+
+    async def main():
+        charged = await limiter.acquire(1000)
+        limiter.settle(charged, 0)
+        assert limiter.stats()["available_tokens"] == pytest.approx(6000)
+
+        charged = await limiter.acquire(1000)
+        limiter.settle(charged, 9000)
+        assert limiter.stats()["available_tokens"] == pytest.approx(-3000, abs=10)
+        # The overspend is waited off before anyone else gets through
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(limiter.acquire(10), 0.2)
+        assert limiter.stats()[LIVE]["waiting"] == 0
+
+    asyncio.run(main())
+
+
+def test_queue_timeout_is_not_charged_or_held_against_the_api(registry):
+    transport = make_transport(registry)
+    transport.rate_limiter = RateLimiter(rpm=1)
+
+    async def main():
+        await read(transport)
+        with pytest.raises(LLMTimeout):
+            await read(transport, dict(REQUEST, system="other"), timeout=0.1)
+        stats = transport.stats()
+        assert stats["queue_timeouts"] == 1 and len(registry.requests) == 1
+        assert transport.breaker.state == "closed" and transport.breaker.failures == 0
+        assert transport.rate_limiter.stats()[LIVE]["waiting"] == 0
+
+    asyncio.run(main())
+
+
+def test_rejected_request_is_refunded(registry):
+    transport = make_transport(registry)
+    transport.rate_limiter = RateLimiter(tpm=6000)
+    registry.failures.append(ValueError("bad request"))
+
+    async def main():
+        with pytest.raises(LLMRequestError):
+            await read(transport)
+        assert transport.rate_limiter.stats()["available_tokens"] == pytest.approx(6000)
+
+    asyncio.run(main())
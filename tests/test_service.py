@@ -0,0 +1,202 @@
+import asyncio
+import json
+
+from service import ConversationService
+
+
+async def call(app, method, path, body=None, query=b""):
+    # One HTTP request through the ASGI app; returns (status, headers, body chunks)
+    payload = json.dumps(body).encode() if body is not None else b""
+    sent = []
+
+    async def receive():
+        return {"type": "http.request", "body": payload}
+
+    async def send(message):
+        sent.append(message)
+
+    await app({"type": "http", "method": method, "path": path, "query_string": query}, receive, send)
+    return sent[0]["status"], dict(sent[0]["headers"]), [m["body"] for m in sent[1:]]
+
+
+async def call_json(app, method, path, body=None):
+    status, headers, chunks = await call(app, method, path, body)
+    return status, json.loads(b"".join(chunks))
+
+
+def label(request, labels):
+    text = request["messages"][-1]["content"].lower()
+    if "confirmed" in labels:
+        return "confirmed" if "speaking" in text else "not_confirmed"
+    if "verified" in labels:
+        return "verified" if any(c.isdigit() for c in text) else "failed"
+    return "other"
+
+
+def test_create_message_and_close(registry, transport):
+    registry.label = label
+    app = ConversationService(transport)
+
+    async def main():
+        status, created = await call_json(app, "POST", "/conversations", {"debtor": {"debtor_name": "Jane Roe"}})
+        assert status == 201 and created["agent"] == "initial"
+        path = f"/conversations/{created['id']}"
+        status, data = await call_json(app, "POST", path + "/messages", {"text": "hello"})
+        assert status == 200 and "Jane Roe" in data["reply"] and not data["cancelled"]
+        status, data = await call_json(app, "POST", path + "/messages", {"text": "yes speaking"})
+        assert data["agent"] == "verification" and "last 4 digits" in data["reply"]
+        status, data = await call_json(app, "GET", path)
+        assert status == 200 and [m["role"] for m in data["transcript"] if m["shown"]] == ["user", "assistant"] * 2
+        status, data = await call_json(app, "DELETE", path)
+        assert status == 200 and data["id"] == created["id"]
+        status, data = await call_json(app, "GET", path)
+        assert status == 404
+
+    asyncio.run(main())
+
+
+def test_streamed_reply(registry, transport):
+    app = ConversationService(transport)
+
+    async def main():
+        _, created = await call_json(app, "POST", "/conversations")
+        path = f"/conversations/{created['id']}/messages"
+        await call(app, "POST", path, {"text": "hello"})
+        # Initial agent's free-form fallback: streamed through the fake in chunks
+        registry.label = lambda request, labels: labels[-1]
+        status, headers, chunks = await call(app, "POST", path, {"text": "who is this"}, b"stream=1")
+        lines = [json.loads(line) for line in b"".join(chunks).splitlines()]
+        assert status == 200 and headers[b"content-type"] == b"application/x-ndjson"
+        assert lines[-1]["done"] and not lines[-1]["cancelled"]
+        assert all("delta" in line for line in lines[:-1])
+
+    asyncio.run(main())
+
+
+def test_new_message_supersedes_running_turn(registry, transport):
+    registry.label = label
+    registry.delay = 0.2
+    app = ConversationService(transport)
+
+    async def main():
+        _, created = await call_json(app, "POST", "/conversations")
+        path = f"/conversations/{created['id']}/messages"
+        await call_json(app, "POST", path, {"text": "hello"})
+        first = asyncio.ensure_future(call_json(app, "POST", path, {"text": "who are you"}))
+        await asyncio.sleep(0.05)
+        second = asyncio.ensure_future(call_json(app, "POST", path, {"text": "yes speaking"}))
+        (_, superseded), (_, answered) = await asyncio.gather(first, second)
+        assert superseded["cancelled"] and not answered["cancelled"]
+        assert answered["agent"] == "verification"
+        _, data = await call_json(app, "GET", f"/conversations/{created['id']}")
+        assert [m["content"] for m in data["transcript"] if m["cancelled"]] == ["who are you"]
+        assert registry.open_streams == 0
+
+    asyncio.run(main())
+
+
+def test_bad_requests(transport):
+    app = ConversationService(transport)
+
+    async def main():
+        _, created = await call_json(app, "POST", "/conversations")
+        path = f"/conversations/{created['id']}/messages"
+        assert (await call_json(app, "POST", path, {"text": "  "}))[0] == 400
+        assert (await call_json(app, "POST", path, {"text": "hi", "turn_id": 5}))[0] == 400
+        assert (await call_json(app, "GET", path))[0] == 405
+        assert (await call_json(app, "GET", "/nowhere"))[0] == 404
+        for debtor in ("x", ["Jane"], {"balance": 1000}):
+            status, data = await call_json(app, "POST", "/conversations", {"debtor": debtor})
+            assert status == 400 and "debtor" in data["error"]
+
+    asyncio.run(main())
+
+
+def test_failed_startup_warm_up_is_retried(registry, transport):
+    import llm_client
+    llm_client._readiness.update(ready=False, error=None)
+    registry.failures += [ConnectionError("unreachable"), ConnectionError("unreachable")]
+    app = ConversationService(transport, warm_up_retry=0.01)
+
+    async def main():
+        lifespan = asyncio.Queue()
+        sent = []
+
+        async def send(message):
+            sent.append(message["type"])
+
+        await lifespan.put({"type": "lifespan.startup"})
+        running = asyncio.ensure_future(app({"type": "lifespan"}, lifespan.get, send))
+        await asyncio.sleep(0.005)
+        assert sent == ["lifespan.startup.complete"]
+        assert (await call_json(app, "GET", "/ready"))[0] == 503
+        await asyncio.sleep(0.1)
+        status, data = await call_json(app, "GET", "/ready")
+        assert status == 200 and data["ready"]
+        await lifespan.put({"type": "lifespan.shutdown"})
+        await running
+
+    asyncio.run(main())
+
+
+def test_repeated_turn_id_joins_the_running_turn(registry, transport):
+    registry.label = label
+    registry.delay = 0.1
+    app = ConversationService(transport)
+
+    async def main():
+        _, created = await call_json(app, "POST", "/conversations")
+        path = f"/conversations/{created['id']}/messages"
+        await call_json(app, "POST", path, {"text": "hello"})
+        body = {"text": "yes speaking", "turn_id": "t1"}
+        first = asyncio.ensure_future(call_json(app, "POST", path, body))
+        await asyncio.sleep(0.05)
+        retry = asyncio.ensure_future(call(app, "POST", path, body, b"stream=1"))
+        (_, data), (_, _, chunks) = await asyncio.wait_for(asyncio.gather(first, retry), 2)
+        lines = [json.loads(line) for line in b"".join(chunks).splitlines()]
+        assert "last 4 digits" in data["reply"] and not data["cancelled"]
+        assert "".join(line.get("delta", "") for line in lines) == data["reply"]
+        # Once finished, the stored reply is replayed
+        _, again = await call_json(app, "POST", path, body)
+        assert again["reply"] == data["reply"]
+        _, shown = await call_json(app, "GET", f"/conversations/{created['id']}")
+        assert shown["stats"]["dedupe_hits"] == 2
+        assert [m["content"] for m in shown["transcript"]].count("yes speaking") == 1
+
+    asyncio.run(main())
+
+
+def test_idle_conversations_are_swept_in_the_background(registry, transport):
+    app = ConversationService(transport, idle_timeout=0.05, sweep_interval=0.02)
+
+    async def main():
+        lifespan = asyncio.Queue()
+        await lifespan.put({"type": "lifespan.startup"})
+
+        async def send(message):
+            pass
+
+        running = asyncio.ensure_future(app({"type": "lifespan"}, lifespan.get, send))
+        _, created = await call_json(app, "POST", "/conversations")
+        await asyncio.sleep(0.15)
+        assert created["id"] not in app.conversations
+        await lifespan.put({"type": "lifespan.shutdown"})
+        await running
+        assert app._sweeping.cancelled()
+
+    asyncio.run(main())
+
+
+def test_health_reports_the_transport_rate_limiter(registry, transport):
+    registry.label = label
+    app = ConversationService(transport)
+
+    async def main():
+        _, created = await call_json(app, "POST", "/conversations")
+        for text in ("hello", "yes speaking"):
+            await call_json(app, "POST", f"/conversations/{created['id']}/messages", {"text": text})
+        status, data = await call_json(app, "GET", "/health")
+        granted = transport.rate_limiter.stats()["live"]["granted"]
+        assert status == 200 and granted > 0 and data["rate_limiter"]["live"]["granted"] == granted
+
+    asyncio.run(main())
@@ -0,0 +1,30 @@
+import asyncio
+
+import horse
+from horse import MultiAgentDebtCollectionBot
+from token_estimator import TOOL_OVERHEAD, TokenEstimator
+
+
+def test_tool_requests_include_the_hidden_tool_prompt():
+    estimator = TokenEstimator()
+    request = {"system": "Be brief.", "messages": [{"role": "user", "content": "hello"}]}
+    tool = {"name": "decide", "input_schema": {"type": "object"}}
+    plain = estimator.estimate_request(request)
+    with_tools = estimator.estimate_request(dict(request, tools=[tool]))
+    assert with_tools - plain > TOOL_OVERHEAD
+
+
+def test_collapsed_calls_are_learned_from_once(registry, transport, monkeypatch):
+    estimator = TokenEstimator()
+    monkeypatch.setattr(horse, "get_token_estimator", lambda: estimator)
+    registry.delay = 0.05
+
+    async def main():
+        bots = [MultiAgentDebtCollectionBot(transport) for _ in range(3)]
+        await asyncio.gather(*[bot.aget_response("hello") for bot in bots])
+        await asyncio.gather(*[bot.aget_response("yes speaking") for bot in bots])
+
+    asyncio.run(main())
+    log = transport.call_log
+    assert any(record["collapsed"] for record in log)
+    assert estimator.stats()["samples"] == sum(not record["collapsed"] for record in log)
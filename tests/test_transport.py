@@ -0,0 +1,143 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import anthropic
+import pytest
+
+from admission import AdmissionController
+from rate_limiter import RateLimiter
+from transport import CircuitBreaker, LLMError, LLMOverloaded, LLMRequestError, LLMTransport, LLMUnavailable
+
+REQUEST = {"model": "m", "max_tokens": 50, "system": "s", "messages": [{"role": "user", "content": "hi"}]}
+
+
+def make_transport(registry, **options):
+    return LLMTransport(registry, base_delay=0.001, rate_limiter=RateLimiter(), admission=AdmissionController(),
+                        **options)
+
+
+async def read(transport, request=REQUEST, **options):
+    async with transport.stream(request, **options) as stream:
+        return "".join([text async for text in stream.text_stream])
+
+
+def test_cancelled_caller_closes_both_hedged_attempts(registry):
+    registry.delay = 0.3
+    transport = make_transport(registry, hedge_percentile=50, hedge_min_samples=1)
+    transport._record_latency(0.01)
+
+    async def main():
+        call = asyncio.ensure_future(read(transport, hedge_budget=transport.new_hedge_budget()))
+        await asyncio.sleep(0.1)
+        call.cancel()
+        await asyncio.gather(call, return_exceptions=True)
+        assert len(registry.requests) == 2
+        await asyncio.sleep(0.4)
+        assert registry.open_streams == 0
+        assert transport.stats()["hedges"] == 1
+        assert not transport.breaker._trial_in_flight
+        assert transport.admission.in_flight == 0
+
+    asyncio.run(main())
+
+
+def test_losing_hedge_is_closed(registry):
+    transport = make_transport(registry, hedge_percentile=50, hedge_min_samples=1)
+    transport._record_latency(0.0)
+
+    async def main():
+        assert await read(transport, hedge_budget=transport.new_hedge_budget()) == "You said: hi"
+        await asyncio.sleep(0.05)
+        assert registry.open_streams == 0
+
+    asyncio.run(main())
+
+
+def test_client_errors_reach_every_caller_of_a_flight(registry, monkeypatch):
+    transport = make_transport(registry)
+
+    def broken_stream(**request):
+        raise TypeError("unexpected keyword")
+
+    monkeypatch.setattr(registry.client.messages, "stream", broken_stream)
+
+    async def main():
+        calls = [read(transport), read(transport)]
+        results = await asyncio.wait_for(asyncio.gather(*calls, return_exceptions=True), 2)
+        assert all(isinstance(result, LLMRequestError) for result in results)
+        assert transport.stats()["collapsed"] == 1
+
+    asyncio.run(main())
+
+    # A bug anywhere under the pump still ends the flight for its readers
+    async def crash(self):
+        raise RuntimeError("bug")
+
+    monkeypatch.setattr("transport._ResilientStream.__aenter__", crash)
+
+    async def crashed():
+        with pytest.raises(LLMError):
+            await asyncio.wait_for(read(transport), 2)
+
+    asyncio.run(crashed())
+
+
+def api_error(cls, status, error_type, retry_after=None):
+    # SDK status errors without an HTTP library: only what _classify and _backoff read
+    error = cls.__new__(cls)
+    Exception.__init__(error, f"{status} {error_type}")
+    error.status_code = status
+    error.body = {"type": "error", "error": {"type": error_type, "message": error_type}}
+    error.response = SimpleNamespace(headers={"retry-after": retry_after} if retry_after else {})
+    return error
+
+
+def test_overload_errors_are_retried(registry):
+    transport = make_transport(registry)
+    registry.failures += [
+        api_error(getattr(anthropic, "OverloadedError", anthropic.APIStatusError), 529, "overloaded_error"),
+        api_error(anthropic.RateLimitError, 429, "rate_limit_error"),
+        api_error(anthropic.InternalServerError, 503, "api_error"),
+    ]
+    assert asyncio.run(read(transport)) == "You said: hi"
+    stats = transport.stats()
+    assert stats["retries"] == 3 and stats["failures"] == 0
+    assert transport.breaker.state == "closed"
+
+
+def test_retries_wait_at_least_retry_after(registry):
+    transport = make_transport(registry)
+    registry.failures.append(api_error(anthropic.RateLimitError, 429, "rate_limit_error", retry_after="0.2"))
+    start = time.monotonic()
+    asyncio.run(read(transport))
+    assert time.monotonic() - start >= 0.2
+
+
+def test_overload_opens_the_breaker_and_bad_requests_do_not(registry):
+    transport = make_transport(registry, max_retries=0, breaker=CircuitBreaker(failure_threshold=2))
+    registry.failures += [api_error(anthropic.BadRequestError, 400, "invalid_request_error")] * 3
+    for _ in range(3):
+        with pytest.raises(LLMRequestError):
+            asyncio.run(read(transport))
+    assert transport.breaker.state == "closed"
+
+    overloaded = getattr(anthropic, "OverloadedError", anthropic.APIStatusError)
+    registry.failures += [api_error(overloaded, 529, "overloaded_error")] * 2
+    for _ in range(2):
+        with pytest.raises(LLMOverloaded):
+            asyncio.run(read(transport))
+    assert transport.breaker.state == "open"
+    with pytest.raises(LLMUnavailable):
+        asyncio.run(read(transport))
+    assert transport.stats()["short_circuited"] == 1
+
+
+def test_overload_sent_inside_the_stream_counts_against_the_api(registry):
+    transport = make_transport(registry, breaker=CircuitBreaker(failure_threshold=1))
+    # An SSE error event on a 200 response comes out as a plain APIStatusError
+    registry.stream_errors.append(api_error(anthropic.APIStatusError, 200, "overloaded_error"))
+    with pytest.raises(LLMOverloaded):
+        asyncio.run(read(transport))
+    assert transport.breaker.state == "open"
+    assert transport.admission.stats()["in_flight"] == 0
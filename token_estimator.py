@@ -0,0 +1,150 @@
+import json
+import threading
+import time
+from collections import deque
+
+_PUNCTUATION = ".,;:!?'\"()<>-/%"
+# Role markers and formatting around each message
+MESSAGE_OVERHEAD = 4
+# System prompt the API adds, unseen, to any request with tools (forced tool choice)
+TOOL_OVERHEAD = 313
+
+
+class TokenEstimator:
+    """Local prompt-size estimate, calibrated against the input tokens the API reports.
+
+    The raw count blends the character length with the number of words and
+    punctuation marks, which tracks the tokenizer well enough for budgets.
+    observe() keeps a running correction factor from real usage, so no call
+    to the token counting endpoint is ever needed.
+    """
+
+    def __init__(self, scale=1.0, smoothing=0.1):
+        self.scale = scale
+        self.smoothing = smoothing
+        self._lock = threading.Lock()
+        self._stats = {"samples": 0, "abs_error": 0.0, "error": 0.0, "estimates": 0, "estimate_seconds": 0.0}
+
+    def count(self, text):
+        # Only C-level string scans, so a whole conversation takes microseconds
+        pieces = len(text.split()) + sum(map(text.count, _PUNCTUATION))
+        return int((len(text) / 4 + pieces) / 2 * self.scale) + 1
+
+    def estimate_request(self, request):
+        """Estimated input tokens for a messages request: system, tools and messages."""
+        start = time.perf_counter()
+        system = request.get("system") or ""
+        if not isinstance(system, str):
+            system = "\n".join(block["text"] for block in system)
+        tokens = self.count(system)
+        if request.get("tools"):
+            tokens += self.count(json.dumps(request["tools"])) + TOOL_OVERHEAD
+        for message in request["messages"]:
+            tokens += self.count(message["content"]) + MESSAGE_OVERHEAD
+        with self._lock:
+            self._stats["estimates"] += 1
+            self._stats["estimate_seconds"] += time.perf_counter() - start
+        return tokens
+
+    def observe(self, estimated, actual):
+        """Record the API's count for a request estimated at `estimated` tokens."""
+        if not actual or not estimated:
+            return
+        with self._lock:
+            error = (estimated - actual) / actual
+            self._stats["samples"] += 1
+            self._stats["abs_error"] += abs(error)
+            self._stats["error"] += error
+            # Nudge the scale towards what would have been exact
+            self.scale *= 1 + self.smoothing * (actual / estimated - 1)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        samples = stats.pop("samples")
+        estimates = stats.pop("estimates")
+        return {
+            "samples": samples,
+            "scale": self.scale,
+            # Error of each estimate as made, before that sample was learned from
+            "mean_abs_error_pct": 100 * stats["abs_error"] / samples if samples else None,
+            "mean_error_pct": 100 * stats["error"] / samples if samples else None,
+            "mean_estimate_us": 1e6 * stats["estimate_seconds"] / estimates if estimates else 0.0,
+        }
+
+
+class OutputBudget:
+    """max_tokens per agent and intent, learned from how long replies really are.
+
+    Until min_samples replies have been seen for a key the default applies;
+    after that the budget is the given percentile of recent reply lengths
+    plus headroom, kept between floor and ceiling. Replies that still hit
+    the budget are continued by the caller and recorded at their full length.
+    """
+
+    def __init__(self, default=150, floor=64, ceiling=1024, percentile=95, headroom=1.25, min_samples=20,
+                 window=200):
+        self.default = default
+        self.floor = floor
+        self.ceiling = ceiling
+        self.percentile = percentile
+        self.headroom = headroom
+        self.min_samples = min_samples
+        self.window = window
+        self._lengths = {}
+        self._truncations = {}
+        self._budgets = {}
+        self._lock = threading.Lock()
+
+    def get(self, agent, intent):
+        with self._lock:
+            return self._budgets.get((agent, intent), self.default)
+
+    def observe(self, agent, intent, output_tokens, truncated=False):
+        key = (agent, intent)
+        with self._lock:
+            lengths = self._lengths.setdefault(key, deque(maxlen=self.window))
+            lengths.append(output_tokens)
+            if truncated:
+                self._truncations[key] = self._truncations.get(key, 0) + 1
+            if len(lengths) >= self.min_samples:
+                ordered = sorted(lengths)
+                length = ordered[int(self.percentile / 100 * (len(ordered) - 1))]
+                self._budgets[key] = min(self.ceiling, max(self.floor, int(length * self.headroom)))
+
+    def stats(self):
+        with self._lock:
+            return {
+                f"{agent}/{intent}": {
+                    "samples": len(lengths),
+                    "budget": self._budgets.get((agent, intent), self.default),
+                    "mean_output_tokens": sum(lengths) / len(lengths),
+                    "truncations": self._truncations.get((agent, intent), 0),
+                }
+                for (agent, intent), lengths in sorted(self._lengths.items())
+            }
+
+
+_estimator = None
+_output_budget = None
+_estimator_lock = threading.Lock()
+
+
+def get_token_estimator():
+    global _estimator
+    with _estimator_lock:
+        if _estimator is None:
+            _estimator = TokenEstimator()
+        return _estimator
+
+
+def estimate_tokens(text):
+    return get_token_estimator().count(text)
+
+
+def get_output_budget():
+    global _output_budget
+    with _estimator_lock:
+        if _output_budget is None:
+            _output_budget = OutputBudget()
+        return _output_budget
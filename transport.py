@@ -0,0 +1,600 @@
+import asyncio
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from collections import deque
+
+import anthropic
+
+from admission import get_admission_controller
+from llm_client import get_registry
+from rate_limiter import LIVE, get_rate_limiter
+from token_estimator import get_token_estimator
+
+
+class LLMError(Exception):
+    """Base class for failures the bot can route on instead of reading them out."""
+
+
+class LLMTimeout(LLMError):
+    pass
+
+
+class LLMOverloaded(LLMError):
+    """Rate limited, overloaded or unreachable after all retries."""
+
+
+class LLMUnavailable(LLMError):
+    """The circuit breaker is open; the call was not attempted."""
+
+
+class LLMRequestError(LLMError):
+    """The API rejected the request itself; retrying will not help."""
+
+
+# OverloadedError (529) is not an InternalServerError, and older SDKs lack it
+_OVERLOAD_ERRORS = (anthropic.RateLimitError, anthropic.InternalServerError, anthropic.APIConnectionError,
+                    getattr(anthropic, "OverloadedError", ()))
+_OVERLOAD_TYPES = {"rate_limit_error", "overloaded_error", "api_error"}
+
+
+def _is_overload(error):
+    # By status code, or by the error type in the body for errors sent inside
+    # an already open stream, which arrive as plain APIStatusErrors
+    status = getattr(error, "status_code", None) or 0
+    if status == 429 or status >= 500:
+        return True
+    body = getattr(error, "body", None)
+    details = body.get("error") if isinstance(body, dict) else None
+    return isinstance(details, dict) and details.get("type") in _OVERLOAD_TYPES
+
+
+class CircuitBreaker:
+    """Opens after consecutive failures, then lets one trial call through per reset_timeout."""
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open" and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = "half_open"
+            if self.state == "half_open" and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = "closed"
+            self.failures = 0
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == "half_open" or self.failures >= self.failure_threshold:
+                self.state = "open"
+                self.opened_at = time.monotonic()
+            self._trial_in_flight = False
+
+    def release(self):
+        # A trial call was cancelled before it could tell us anything
+        with self._lock:
+            self._trial_in_flight = False
+
+
+class HedgeBudget:
+    """Caps how many hedged duplicate requests one conversation may send."""
+
+    def __init__(self, max_hedges):
+        self.remaining = max_hedges
+
+    def take(self):
+        if self.remaining <= 0:
+            return False
+        self.remaining -= 1
+        return True
+
+
+class LLMTransport:
+    """The one path agents use to reach the API.
+
+    Each call gets an overall deadline, overload and rate-limit errors are
+    retried with jittered exponential backoff, and a shared circuit breaker
+    fails calls fast while the API is degraded. Failures surface as LLMError
+    subclasses rather than SDK exceptions.
+
+    With hedge_percentile set, a call whose first token has not arrived by
+    that percentile of recent first-token latencies is duplicated, and
+    whichever stream starts first is used.
+
+    With single_flight on, a request byte-identical to one already in flight
+    (same model, system prompt, messages and parameters) does not go
+    upstream; it joins that stream and receives the same chunks.
+
+    Every request sent upstream, retries and hedges included, first waits
+    its turn at the process-wide rate limiter, at the priority of the call.
+    Calls are also reported to the admission controller, which sheds new
+    conversations from that load.
+    """
+
+    def __init__(self, registry=None, timeout=20.0, max_retries=3, base_delay=0.5, max_delay=8.0, breaker=None,
+                 hedge_percentile=None, hedge_budget=2, hedge_min_samples=20, single_flight=True, rate_limiter=None, admission=None):
+        self.registry = registry or get_registry()
+        self.rate_limiter = rate_limiter or get_rate_limiter()
+        self.admission = admission or get_admission_controller()
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.breaker = breaker or CircuitBreaker()
+        self.hedge_percentile = hedge_percentile
+        self.hedge_budget = hedge_budget
+        self.hedge_min_samples = hedge_min_samples
+        self.single_flight = single_flight
+        self._flights = {}
+        self._latencies = deque(maxlen=200)
+        # Recent per-call records (agent, turn type, model, latency, tokens)
+        self.call_log = deque(maxlen=5000)
+        self._lock = threading.Lock()
+        self._stats = {
+            "calls": 0,
+            "successes": 0,
+            "failures": 0,
+            "retries": 0,
+            "timeouts": 0,
+            "short_circuited": 0,
+            "queue_timeouts": 0,
+            "hedges": 0,
+            "hedges_won": 0,
+            "hedges_over_budget": 0,
+            "flights": 0,
+            "collapsed": 0,
+        }
+
+    @classmethod
+    def from_env(cls, registry=None):
+        return cls(
+            registry,
+            timeout=float(os.getenv("LLM_TIMEOUT", 20)),
+            max_retries=int(os.getenv("LLM_MAX_RETRIES", 3)),
+            breaker=CircuitBreaker(
+                failure_threshold=int(os.getenv("LLM_BREAKER_THRESHOLD", 5)),
+                reset_timeout=float(os.getenv("LLM_BREAKER_RESET", 30)),
+            ),
+            hedge_percentile=float(os.getenv("LLM_HEDGE_PERCENTILE")) if os.getenv("LLM_HEDGE_PERCENTILE") else None,
+            hedge_budget=int(os.getenv("LLM_HEDGE_BUDGET", 2)),
+            single_flight=os.getenv("LLM_SINGLE_FLIGHT", "1") != "0",
+        )
+
+    def stream(self, request, timeout=None, hedge_budget=None, events=False, priority=LIVE, estimated_tokens=None):
+        """Async context manager over a streamed completion; see _ResilientStream.
+
+        Read it through .text_stream for text deltas, or with events=True
+        through .events for the raw stream events (e.g. tool input JSON).
+        .collapsed is true when the call joined an identical one in flight.
+        priority is one of rate_limiter.PRIORITIES; estimated_tokens is the
+        prompt estimate if the caller already made one.
+        """
+        if estimated_tokens is None:
+            estimated_tokens = get_token_estimator().estimate_request(request)
+        # Charged up front: the prompt plus the most the reply may use
+        tokens = estimated_tokens + request.get("max_tokens", 0)
+        if not self.single_flight:
+            return _ResilientStream(self, request, timeout or self.timeout, hedge_budget, events, priority, tokens)
+        payload = json.dumps([request, events], sort_keys=True).encode()
+        key = (asyncio.get_running_loop(), hashlib.sha256(payload).digest())
+        flight = self._flights.get(key)
+        if flight is None:
+            self._count("flights")
+            stream = _ResilientStream(self, request, timeout or self.timeout, hedge_budget, events, priority, tokens)
+            flight = self._flights[key] = _Flight(stream, lambda: self._flights.pop(key, None))
+            return flight.join(False)
+        self._count("collapsed")
+        return flight.join(True)
+
+    def new_hedge_budget(self):
+        return HedgeBudget(self.hedge_budget)
+
+    def hedge_delay(self):
+        # None until hedging is enabled and there are enough samples to trust
+        if self.hedge_percentile is None:
+            return None
+        with self._lock:
+            latencies = sorted(self._latencies)
+        if len(latencies) < self.hedge_min_samples:
+            return None
+        return latencies[int(self.hedge_percentile / 100 * (len(latencies) - 1))]
+
+    def record_call(self, record):
+        with self._lock:
+            self.call_log.append(record)
+
+    def call_report(self):
+        """Mean latency and token usage per agent, turn type and model over the call log."""
+        with self._lock:
+            records = list(self.call_log)
+        groups = {}
+        for record in records:
+            key = (record["agent"], record["turn_type"], record["model"])
+            group = groups.setdefault(key, {"calls": 0, "latency_seconds": 0.0, "first_token_seconds": 0.0,
+                                            "input_tokens": 0, "output_tokens": 0})
+            group["calls"] += 1
+            group["latency_seconds"] += record["latency_seconds"]
+            group["first_token_seconds"] += record["first_token_seconds"] or 0.0
+            group["input_tokens"] += record["input_tokens"]
+            group["output_tokens"] += record["output_tokens"]
+        report = []
+        for (agent, turn_type, model), group in sorted(groups.items()):
+            calls = group.pop("calls")
+            report.append(dict(
+                {"agent": agent, "turn_type": turn_type, "model": model, "calls": calls},
+                **{"mean_" + name: total / calls for name, total in group.items()}
+            ))
+        return report
+
+    def _record_latency(self, seconds):
+        with self._lock:
+            self._latencies.append(seconds)
+
+    async def _open(self, request, deadline, priority=LIVE, tokens=0):
+        self._count("calls")
+        if not self.breaker.allow():
+            self._count("short_circuited")
+            raise LLMUnavailable("LLM circuit breaker is open")
+        attempt = 0
+        while True:
+            try:
+                charged = await asyncio.wait_for(self.rate_limiter.acquire(tokens, priority),
+                                                 deadline - time.monotonic())
+            except BaseException as e:
+                # Never sent, so it says nothing about the API's health
+                self.breaker.release()
+                if not isinstance(e, asyncio.TimeoutError):
+                    raise
+                self._count("failures")
+                self._count("queue_timeouts")
+                raise LLMTimeout("LLM call timed out waiting for the rate limiter") from e
+            remaining = deadline - time.monotonic()
+            try:
+                manager = self.registry.get_async_client().messages.stream(**request, timeout=remaining)
+                return manager, await asyncio.wait_for(manager.__aenter__(), remaining), charged
+            except asyncio.CancelledError:
+                self.rate_limiter.settle(charged, 0)
+                self.breaker.release()
+                raise
+            except Exception as e:
+                # Rejected requests are not billed
+                self.rate_limiter.settle(charged, 0)
+                error = self._classify(e)
+                delay = self._backoff(attempt, e)
+                if not isinstance(error, (LLMOverloaded, LLMTimeout)) or attempt >= self.max_retries \
+                        or time.monotonic() + delay >= deadline:
+                    self._failed(error)
+                    raise error from e
+            attempt += 1
+            self._count("retries")
+            await asyncio.sleep(delay)
+
+    async def _close(self, manager, stream, charged, exc_type=None, exc=None, tb=None):
+        await manager.__aexit__(exc_type, exc, tb)
+        try:
+            usage = stream.current_message_snapshot.usage
+        except Exception:
+            # Closed before message_start; keep the estimate
+            return
+        # Cache reads do not count towards the token limit
+        used = (usage.input_tokens or 0) + (getattr(usage, "cache_creation_input_tokens", None) or 0) \
+            + (usage.output_tokens or 0)
+        self.rate_limiter.settle(charged, used)
+
+    def _backoff(self, attempt, error):
+        # Full jitter, but never sooner than the server asked for
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        response = getattr(error, "response", None)
+        retry_after = response.headers.get("retry-after") if response is not None else None
+        if retry_after:
+            try:
+                delay = max(delay, float(retry_after))
+            except ValueError:
+                pass
+        return delay
+
+    def _classify(self, error):
+        if isinstance(error, LLMError):
+            return error
+        if isinstance(error, (asyncio.TimeoutError, anthropic.APITimeoutError)):
+            return LLMTimeout(str(error) or "LLM call timed out")
+        if isinstance(error, _OVERLOAD_ERRORS) or _is_overload(error):
+            return LLMOverloaded(str(error))
+        return LLMRequestError(str(error))
+
+    def _failed(self, error):
+        self._count("failures")
+        if isinstance(error, LLMTimeout):
+            self._count("timeouts")
+        # A bad request says nothing about the API's health
+        if isinstance(error, LLMRequestError):
+            self.breaker.record_success()
+        else:
+            self.breaker.record_failure()
+
+    def _succeeded(self):
+        self._count("successes")
+        self.breaker.record_success()
+
+    def _count(self, name, n=1):
+        with self._lock:
+            self._stats[name] += n
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        attempted = stats["calls"] - stats["short_circuited"]
+        stats["failure_rate"] = stats["failures"] / attempted if attempted else 0.0
+        stats["breaker_state"] = self.breaker.state
+        return stats
+
+
+class _ResilientStream:
+    # Wraps the SDK MessageStream: retries happen while opening, the first
+    # chunk may be raced against a hedged duplicate, and the deadline also
+    # covers every chunk read afterwards
+
+    def __init__(self, transport, request, timeout, hedge_budget=None, events=False, priority=LIVE, tokens=0):
+        self.transport = transport
+        self.request = request
+        self.timeout = timeout
+        self.hedge_budget = hedge_budget
+        self.raw_events = events
+        self.priority = priority
+        self.tokens = tokens
+        self.collapsed = False
+        self._manager = None
+        self._stream = None
+        self._failed = False
+        self._latency = None
+
+    async def __aenter__(self):
+        start = time.monotonic()
+        self._deadline = start + self.timeout
+        self.transport.admission.call_started()
+        try:
+            self._manager, self._stream, self._charged, self._chunks, self._first = await self._first_chunk()
+        except BaseException as e:
+            # A rejected request says nothing about the load
+            self.transport.admission.call_finished(
+                failed=isinstance(e, LLMError) and not isinstance(e, LLMRequestError))
+            if isinstance(e, LLMError):
+                self._failed = True
+            raise
+        self._latency = time.monotonic() - start
+        self.transport._record_latency(self._latency)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        try:
+            await self.transport._close(self._manager, self._stream, self._charged, exc_type, exc, tb)
+        finally:
+            self.transport.admission.call_finished(self._latency, self._failed)
+        if not self._failed:
+            # Includes streams the caller closed early on purpose
+            self.transport._succeeded()
+
+    async def _first_chunk(self):
+        attempts = [asyncio.ensure_future(self._attempt())]
+        winner = None
+        try:
+            winner = await self._race(attempts)
+        finally:
+            # Also when the caller is cancelled mid-race: no attempt may outlive
+            # it with an open stream, an unsettled rate-limit charge or a breaker trial
+            losers = [task for task in attempts if task is not winner]
+            for task in losers:
+                task.cancel()
+            await asyncio.gather(*losers, return_exceptions=True)
+            for task in losers:
+                # Close the losing stream, which stops its generation
+                if not task.cancelled() and task.exception() is None:
+                    await self.transport._close(*task.result()[:3])
+        return winner.result()
+
+    async def _race(self, attempts):
+        # The attempt to use: the first to open, or the primary when none did
+        primary = attempts[0]
+        delay = self.transport.hedge_delay()
+        if delay is None:
+            await asyncio.wait({primary})
+            return primary
+        done, _ = await asyncio.wait({primary}, timeout=delay)
+        if done:
+            return primary
+        if self.hedge_budget is None or not self.hedge_budget.take():
+            self.transport._count("hedges_over_budget")
+            await asyncio.wait({primary})
+            return primary
+
+        self.transport._count("hedges")
+        hedge = asyncio.ensure_future(self._attempt())
+        attempts.append(hedge)
+        pending = {primary, hedge}
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if not task.cancelled() and task.exception() is None:
+                    if task is hedge:
+                        self.transport._count("hedges_won")
+                    return task
+        return primary
+
+    async def _attempt(self):
+        # Open a stream (with retries) and read its first chunk
+        manager, stream, charged = await self.transport._open(self.request, self._deadline, self.priority,
+                                                              self.tokens)
+        chunks = (stream if self.raw_events else stream.text_stream).__aiter__()
+        try:
+            first = await self._next(chunks)
+        except BaseException as e:
+            if isinstance(e, asyncio.CancelledError):
+                self.transport.breaker.release()
+            await self.transport._close(manager, stream, charged)
+            raise
+        return manager, stream, charged, chunks, first
+
+    async def _next(self, chunks):
+        # None once the stream is exhausted
+        try:
+            return await asyncio.wait_for(chunks.__anext__(), self._deadline - time.monotonic())
+        except StopAsyncIteration:
+            return None
+        except Exception as e:
+            error = self.transport._classify(e)
+            self.transport._failed(error)
+            raise error from e
+
+    @property
+    def text_stream(self):
+        return self._iter_chunks()
+
+    @property
+    def events(self):
+        return self._iter_chunks()
+
+    async def _iter_chunks(self):
+        text = self._first
+        while text is not None:
+            yield text
+            try:
+                text = await self._next(self._chunks)
+            except LLMError:
+                self._failed = True
+                raise
+
+    @property
+    def usage(self):
+        return self._stream.current_message_snapshot.usage
+
+    @property
+    def stop_reason(self):
+        # None while the stream is still open or when it was closed early
+        return self._stream.current_message_snapshot.stop_reason
+
+
+class _Flight:
+    # One upstream stream whose chunks are fanned out to every request that
+    # joined it. The upstream is read by its own task, so one caller leaving
+    # early does not cut the others short; it is closed once all have left
+
+    def __init__(self, stream, on_done):
+        self.stream = stream
+        self.chunks = []
+        self.queues = []
+        self.done = False
+        self._on_done = on_done
+        self._task = None
+
+    def join(self, collapsed):
+        queue = asyncio.Queue()
+        for chunk in self.chunks:
+            queue.put_nowait(chunk)
+        self.queues.append(queue)
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._pump())
+        return _SharedStream(self, queue, collapsed)
+
+    def leave(self, queue):
+        self.queues.remove(queue)
+        if not self.queues and not self._task.done():
+            self._task.cancel()
+            self._on_done()
+
+    async def _pump(self):
+        try:
+            async with self.stream:
+                async for chunk in self.stream.events if self.stream.raw_events else self.stream.text_stream:
+                    self.chunks.append(chunk)
+                    for queue in self.queues:
+                        queue.put_nowait(chunk)
+            self._finish(None)
+        except Exception as e:
+            # Anything unexpected still has to reach the readers, or they wait forever
+            self._finish(self.stream.transport._classify(e))
+
+    def _finish(self, end):
+        # None marks a complete stream; an LLMError is raised to every reader
+        self.done = True
+        self._on_done()
+        for queue in self.queues:
+            queue.put_nowait(end)
+
+
+class _SharedStream:
+    # What a caller of LLMTransport.stream gets with single flight on; reads
+    # like _ResilientStream, including the error on entry if the call fails
+
+    def __init__(self, flight, queue, collapsed):
+        self._flight = flight
+        self._queue = queue
+        self.collapsed = collapsed
+
+    async def __aenter__(self):
+        try:
+            self._first = await self._queue.get()
+        except asyncio.CancelledError:
+            self._flight.leave(self._queue)
+            raise
+        if isinstance(self._first, LLMError):
+            self._flight.leave(self._queue)
+            raise self._first
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self._flight.leave(self._queue)
+
+    @property
+    def text_stream(self):
+        return self._iter_chunks()
+
+    @property
+    def events(self):
+        return self._iter_chunks()
+
+    async def _iter_chunks(self):
+        chunk = self._first
+        while chunk is not None:
+            if isinstance(chunk, LLMError):
+                raise chunk
+            yield chunk
+            chunk = await self._queue.get()
+
+    @property
+    def usage(self):
+        return self._flight.stream.usage
+
+    @property
+    def stop_reason(self):
+        return self._flight.stream.stop_reason
+
+
+_transport = None
+_transport_lock = threading.Lock()
+
+
+def get_transport():
+    global _transport
+    with _transport_lock:
+        if _transport is None:
+            _transport = LLMTransport.from_env()
+        return _transport